@@ -0,0 +1,727 @@
+#!/usr/bin/python
+import argparse
+import asyncio
+import collections
+import gc
+import html
+import json
+import platform
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+import ch
+import ch.mockserver
+
+# message bodies as they come in b/i frames, used when no recorded room is given
+SAMPLES = [
+    '<n000/><f x12000="0">hello',
+    '<n3452/>hi everyone',
+    '<nf0f/><f x11F00="1">lol &amp; that&#39;s it',
+    '<n0a7/><f x10000="Arial">line one</f></p><p><f x10000="Arial">line two',
+    '<n33c/><f x12333="8">check <a href="http://example.com/x?a=1&amp;b=2" target="_blank">http://example.com/x?a=1&amp;b=2</a>',
+    '<n000/><f x12000="0"><b>bold</b> <i>italic</i> <u>under</u>',
+    '<f x1400F="2">&lt;3 you :) :D',
+    'plain text without any tags',
+    '<n000/><f x12000="0">' + 'spam ' * 100,
+    '<n6c0/><f x12CC0="Comic Sans MS">a &lt; b &gt; c',
+    '<n000/><f x12000="0"><img src="http://ust.chatango.com/um/x/y/img.png"/>',
+]
+
+
+def legacy_clean_message(msg):
+    n = re.search("<n(.*?)/>", msg)
+    if n:
+        n = n.group(1)
+    f = re.search("<f(.*?)>", msg)
+    if f:
+        f = f.group(1)
+    msg = re.sub("<n.*?/>", "", msg)
+    msg = re.sub("<f.*?>", "", msg)
+    msg = legacy_strip_html(msg)
+    msg = html.unescape(msg)
+    return msg, n, f
+
+
+def legacy_strip_html(msg):
+    li = msg.split("<")
+    if len(li) == 1:
+        return li[0]
+    else:
+        ret = list()
+        for data in li:
+            data = data.split(">", 1)
+            if len(data) == 1:
+                ret.append(data[0])
+            elif len(data) == 2:
+                ret.append(data[1])
+        return "".join(ret)
+
+
+# noinspection PyBroadException
+def legacy_parseFont(f):
+    try:
+        sizecolor, fontface = f.split("=", 1)
+        sizecolor = sizecolor.strip()
+        size = int(sizecolor[1:3])
+        col = sizecolor[3:6]
+        if col == "":
+            col = None
+        face = f.split("\"", 2)[1]
+        return col, face, size
+    except:
+        return None, None, None
+
+
+def legacy_scan(msg):
+    msg, n, f = legacy_clean_message(msg)
+    if f:
+        return (msg, n) + legacy_parseFont(f)
+    return msg, n, None, None, None
+
+
+def message_bodies(frames):
+    """Bodies of the b and i frames among recorded frames."""
+    return [frame.split(":", 9)[9] for frame in frames if frame.startswith(("b:", "i:")) and frame.count(":") >= 9]
+
+
+def fuzz_bodies(count=100000, seed=0):
+    """Random, mostly broken markup, where the single pass has to fall back to match the old parser."""
+    rnd = random.Random(seed)
+    pieces = ["<", ">", "/>", "n", "f", "<n", "<f", "<n000/>", '<f x12000="0">', "</f>", "<b>", "a", " ", "&amp;",
+              "&lt;", "=", '"', "x", "1", "\r", "\n", "<br/>", "x12", "Arial"]
+    return ["".join(rnd.choice(pieces) for _ in range(rnd.randint(0, 12))) for _ in range(count)]
+
+
+def bench(name, func, bodies, number):
+    best = min(timeit.repeat(lambda: [func(body) for body in bodies], number=number, repeat=5))
+    per = best / (number * len(bodies))
+    print("%-28s %8.2f us/msg %12.0f msg/s" % (name, per * 1e6, 1 / per))
+    return per
+
+
+def bench_messages(bodies=None):
+    """
+    Compare scan_message to the old parser.
+
+    Pass the bodies of a recorded room (--record FILE --room NAME, then --frames FILE),
+    the built-in samples are only a fallback.
+    """
+    source = "recorded" if bodies else "built-in sample"
+    bodies = bodies or SAMPLES
+    print("== message parsing (%d %s bodies) ==" % (len(bodies), source))
+    for body in bodies:
+        assert ch.scan_message(body) == legacy_scan(body), body
+    fuzzed = fuzz_bodies()
+    differ = [body for body in fuzzed if ch.scan_message(body) != legacy_scan(body)]
+    assert not differ, differ[:10]
+    print("identical to the old parser on those and %d fuzzed bodies" % len(fuzzed))
+    number = max(1, 20000 // len(bodies))
+    old = bench("legacy clean+parseFont", legacy_scan, bodies, number)
+    new = bench("scan_message", ch.scan_message, bodies, number)
+    print("speedup: %.2fx" % (old / new))
+
+
+def measure(build):
+    tracemalloc.start()
+    objs = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objs
+    return size
+
+
+class LegacyMessage:
+    """Message as it was before __slots__, with the body and font parsed when built."""
+
+    def __init__(self, **kw):
+        self.mid = None
+        self.time = None
+        self.user = None
+        self.body = None
+        self.room = None
+        self.raw = ""
+        self.ip = None
+        self.channel = ""
+        self.mid = ""
+        self.puid = ""
+        self.nameColor = "000"
+        self.fontSize = 12
+        self.fontFace = "0"
+        self.fontColor = "000"
+        for attr, val in kw.items():
+            if val is None:
+                continue
+            setattr(self, attr, val)
+
+
+class LegacyUser:
+    """User as it was before __slots__, with its dicts and list made upfront."""
+
+    def __init__(self, name):
+        self.name = name
+        self.puid = None
+        self.puids = set()
+        self.ip = None
+        self.ips = set()
+        self.perms = dict()
+        self.room = None
+        self.sids = dict()
+        self.msgs = list()
+        self.nameColor = "000"
+        self.fontSize = 12
+        self.fontFace = "0"
+        self.fontColor = "000"
+        self.mbg = False
+        self.mrec = False
+
+    def update(self, **kw):
+        for attr, val in kw.items():
+            if val is None:
+                continue
+            if attr == "ip":
+                self.ip = val
+                self.ips.add(val)
+            elif attr == "puid":
+                self.puid = val
+                self.puids.add(val)
+            else:
+                setattr(self, attr, val)
+
+
+def bench_memory(count=10000):
+    print("== memory (%d objects) ==" % count)
+
+    def messages(cls):
+        def build():
+            return [cls(time=1412345.1 + i, raw=SAMPLES[i % len(SAMPLES)], ip="1.2.3.4", i=str(i),
+                        unid="abcdef0123", channel="0", puid="12345678") for i in range(count)]
+        return build
+
+    def legacy_parsed():
+        li = messages(LegacyMessage)()
+        for msg in li:
+            msg.body, n, f = legacy_clean_message(msg.raw)
+            if f:
+                msg.fontColor, msg.fontFace, msg.fontSize = legacy_parseFont(f)
+        return li
+
+    def parsed():
+        li = messages(ch.Message)()
+        for msg in li:
+            msg.body, msg.user
+        return li
+
+    def users(cls):
+        def build():
+            li = list()
+            for i in range(count):
+                user = cls("user%d" % i)
+                user.update(puid="1234%04d" % i, ip="10.0.%d.%d" % (i // 256 % 256, i % 256))
+                li.append(user)
+            return li
+        return build
+
+    # both sides in the same state, so only __slots__ and the lazy containers make the difference
+    for name, old, new in (("Message, unparsed", messages(LegacyMessage), messages(ch.Message)),
+                           ("Message, body read", legacy_parsed, parsed),
+                           ("User", users(LegacyUser), users(ch.user._User))):
+        old, new = measure(old), measure(new)
+        print("%-28s %10.1f KiB -> %10.1f KiB (%+.0f%%)" % (name, old / 1024, new / 1024, (new / old - 1) * 100))
+
+
+def legacy_getServer(group):
+    sn = ch.specials.get(group)
+    if not sn:
+        group = group.replace("_", "q").replace("-", "q")
+        lnv = int(group[6:9] or 'rs', 36)
+        num = (int(group[:5], 36) % lnv) / lnv
+        for wgt, s in ch.wgts:
+            if num <= wgt:
+                sn = s
+                break
+    return "s" + str(sn) + ".chatango.com"
+
+
+def bench_servers(count=5000, number=5):
+    print("== tag server lookup (%d rooms) ==" % count)
+    rooms = ["room%dname%d" % (i, i * 7919 % 1000) for i in range(count)]
+    assert ch.getServers(rooms) == [legacy_getServer(room) for room in rooms]
+
+    def run(name, func):
+        best = min(timeit.repeat(func, number=number, repeat=5)) / (number * count)
+        print("%-28s %8.2f us/room %11.0f room/s" % (name, best * 1e6, 1 / best))
+        return best
+
+    old = run("legacy linear walk", lambda: [legacy_getServer(room) for room in rooms])
+    ch.serverCacheSize = 0
+    ch.updateWeights()
+    bisect = run("bisect, no memo", lambda: [ch.getServer(room) for room in rooms])
+    ch.serverCacheSize = count
+    ch.getServers(rooms)
+    run("getServer, memoized", lambda: [ch.getServer(room) for room in rooms])
+    new = run("getServers, memoized", lambda: ch.getServers(rooms))
+    print("speedup: %.2fx without the memo, %.2fx with it" % (old / bisect, old / new))
+
+    # the memo evicts the least recently used room, not the oldest one
+    ch.serverCacheSize = 2
+    ch.updateWeights()
+    ch.getServers(rooms[:2])
+    ch.getServer(rooms[0])
+    ch.getServer(rooms[2])
+    assert list(ch._servers) == [rooms[0], rooms[2]], list(ch._servers)
+    ch.serverCacheSize = 4096
+    ch.updateWeights()
+
+
+def stress_registry(threads=16, rounds=2000, names=200):
+    """Hammer ch.User from many threads, nobody may see a duplicate user, a lost update or a half applied style."""
+    print("== user registry (%d threads x %d rounds) ==" % (threads, rounds))
+
+    class FakeRoom:
+        def __init__(self, name):
+            self.name = name
+
+    rooms = [FakeRoom("room%d" % i) for i in range(4)]
+    # pending styles get applied by whichever thread reads one first
+    styles = [ch.Message(raw=sample) for sample in SAMPLES]
+    faces = {style.style()[2] for style in styles} | {"0"}
+    seen = [dict() for _ in range(threads)]
+    errors = list()
+    ended = [0.0] * threads
+    barrier = threading.Barrier(threads)
+
+    def worker(n):
+        try:
+            barrier.wait()
+            for i in range(rounds):
+                name = "Stress%d" % ((i * 7 + n) % names)
+                room = rooms[i % len(rooms)]
+                sid = "%d.%d" % (n, i)
+                user = ch.User(name, ip="10.0.0.%d" % n, participant=("1", room, sid), style=styles[i % len(styles)])
+                seen[n].setdefault(name.lower(), set()).add(id(user))
+                _ = user.roomNames, user.sessionids
+                _ = user.nameColor, user.fontColor, user.fontFace, user.fontSize
+                ch.User(name.upper(), participant=("0", room, sid))
+            ended[n] = time.perf_counter()
+            barrier.wait()
+            if n == 0:
+                sys.setswitchinterval(1e-5)  # switch threads often, races show up sooner
+            for i in range(rounds // 10):
+                # everyone reads a style the moment it got set
+                user = users[i % names]
+                if n == 0:
+                    user.update(style=ch.Message(raw=SAMPLES[i % len(SAMPLES)]))
+                barrier.wait()
+                _ = user.nameColor, user.fontFace
+                barrier.wait()
+        except threading.BrokenBarrierError:
+            pass
+        except Exception as e:
+            errors.append(e)
+            barrier.abort()
+
+    users = [ch.User("Stress%d" % i) for i in range(names)]
+    li = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    interval = sys.getswitchinterval()
+    began = time.perf_counter()
+    for t in li:
+        t.start()
+    for t in li:
+        t.join()
+    took = max(ended) - began
+    sys.setswitchinterval(interval)
+
+    assert not errors, errors
+    for user in users:
+        lname = user.name.lower()
+        ids = set().union(*(s.get(lname, set()) for s in seen))
+        assert ids == {id(user)}, "duplicate users for %s" % user.name
+        assert not user.sids, "leftover sessions for %s" % user.name
+        expected = {"10.0.0.%d" % n for n in range(threads) if lname in seen[n]}
+        assert user.ips == expected, "lost ips for %s" % user.name
+        assert user.fontFace in faces and user.fontSize in range(9, 23), "bad style for %s" % user.name
+    ops = threads * rounds * 2
+    print("%-28s %8.2f us/op %12.0f op/s" % ("User() + update", took / ops * 1e6, ops / took))
+    print("registry: %r" % ch.user.registry.stats())
+
+
+def check_reconnect(rooms=20, timeout=20):
+    """Kick every client off a mock tag server, both managers must get all rooms back through the reconnector."""
+    print("== reconnect after a tag server restart (%d rooms) ==" % rooms)
+    names = sorted("reconnect%d" % i for i in range(rooms))
+
+    def check(mock, mgr, wait, call):
+        bauths = mock.stats()["framesIn"].get("bauth", 0)
+        wait(lambda: mock.stats()["roomConnections"] == rooms)
+        for n, restart in enumerate(("kicked", "reconnected while live")):
+            began = time.perf_counter()
+            if n == 0:
+                for name in names:
+                    mock.call(mock.room(name).kick)
+            else:
+                for name in names:
+                    call(mgr.getRoom(name).reconnect)
+            wait(lambda: mgr.reconnector.stats()["recovered"] == rooms * (n + 1))
+            took = time.perf_counter() - began
+            stats = mgr.reconnector.stats()
+            sent = mock.stats()["framesIn"]["bauth"] - bauths
+            assert not stats["failed"], stats
+            assert sent == rooms * (n + 2), "%d bauth for %d rooms" % (sent, rooms)
+            wait(lambda: mock.stats()["roomConnections"] == rooms)
+            assert sorted(mgr.rooms) == names
+            print("%-18s %-22s %8.3f s, max recovery %.3f s" % (
+                type(mgr).__bases__[0].__name__, restart, took, stats["maxRecover"]))
+
+    def until(cond, sleep):
+        end = time.monotonic() + timeout
+        while not cond():
+            assert time.monotonic() < end, "timed out"
+            sleep()
+
+    class Threaded(ch.RoomManager):
+        reconnectDelay = 0.05
+
+        def onDisconnect(self, room):
+            room.reconnect()
+
+    class Async(ch.AsyncRoomManager):
+        reconnectDelay = 0.05
+
+        def onDisconnect(self, room):
+            room.reconnect()
+
+    with ch.mockserver.MockChatango() as mock:
+        mgr = mock.configure(Threaded)(pm=False)
+        threading.Thread(target=mgr.main, daemon=True).start()
+        for name in names:
+            mgr.joinRoom(name)
+        check(mock, mgr, lambda cond: until(cond, lambda: time.sleep(0.01)), lambda func: func())
+        mgr.stop()
+
+        async def run():
+            amgr = mock.configure(Async)(pm=False)
+            started = asyncio.ensure_future(amgr.start(names))
+            # the checks block, so they run next to the loop
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, check, mock, amgr, lambda cond: until(cond, lambda: time.sleep(0.01)),
+                                       lambda func: loop.call_soon_threadsafe(func))
+            amgr.stop()
+            await started
+
+        asyncio.run(run())
+
+
+class BenchRoom(ch.Room):
+    """A room that never connects, frames get fed to it by hand."""
+
+    def _connect(self):
+        self.participant_lock = False
+
+
+def synthetic_frames(count=4000, users=200, seed=0):
+    """
+    Build a stream of room frames like a busy room sends them.
+
+    @rtype: [str, ...]
+    @return: frames without their terminator
+    """
+    rnd = random.Random(seed)
+    names = ["user%d" % i for i in range(users)]
+    frames = ["g_participants:" + ";".join(
+        "%d:1412345678.%02d:%08d:%s:None:x" % (i, i % 100, 10000000 + i, name) for i, name in enumerate(names))]
+    frames.extend("i:1412345%03d.1:%s::%08d:unid%d:%d:1.2.3.4:0::%s" % (
+        i, rnd.choice(names), 10000000 + i, i, 900000 + i, SAMPLES[i % len(SAMPLES)]) for i in range(20))
+    joined = 0
+    for i in range(count):
+        kind = rnd.random()
+        if kind < 0.7:
+            name = rnd.choice(names)
+            frames.append("b:1412345%03d.25:%s::%08d:unid%d:%d:1.2.3.4:0::%s" % (
+                i % 1000, name, 10000000 + i % users, i % users, i, SAMPLES[i % len(SAMPLES)]))
+            frames.append("u:%d:%d" % (i, 1000000 + i))
+        elif kind < 0.85 or not joined:
+            sid = 100000 + i
+            frames.append("participant:1:%d:%08d:guest%d:None:x:1412345%03d.5" % (sid, 20000000 + i, i, i % 1000))
+            joined = sid
+        else:
+            frames.append("participant:0:%d:%08d:guest%d:None:x:1412345%03d.5" % (
+                joined, 20000000 + joined - 100000, joined - 100000, i % 1000))
+            joined = 0
+        if i % 20 == 0:
+            frames.append("n:%x" % (users + i % 50))
+    return frames
+
+
+def load_frames(path):
+    """Read frames recorded with --record."""
+    with open(path, "rb") as f:
+        return [frame.rstrip("\r\n") for frame in ch.common.Framer().feed(f.read()) if frame.rstrip("\r\n")]
+
+
+def record_frames(path, seconds=5.0, rate=200, users=200, churn=20, room=None):
+    """
+    Record what a client of a room receives, for replaying with --frames.
+
+    Records a busy mock room, or joins the live room given anonymously and records its history and traffic.
+    """
+    if room:
+        sock = socket.create_connection((ch.getServer(room), ch.RoomManager.roomPort))
+        sock.sendall(b"bauth:%s:::\x00" % room.encode())
+        data = bytearray()
+        sock.settimeout(0.5)
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            try:
+                chunk = sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not chunk:
+                break
+            data += chunk
+        sock.close()
+        with open(path, "wb") as f:
+            f.write(data)
+        print("recorded %d bytes, %d frames from %s to %s" % (len(data), data.count(b"\x00"), room, path))
+        return
+    with ch.mockserver.MockChatango() as mock:
+        for i in range(mock.historyOnJoin):
+            mock.call(mock.room("bench").post, "user%d" % i, SAMPLES[i % len(SAMPLES)])
+        for i in range(users):
+            mock.call(mock.room("bench").join, "user%d" % i)
+        sock = socket.create_connection((mock.host, mock.roomPort))
+        sock.sendall(b"bauth:bench:::\x00")
+        sock.sendall(b"g_participants\r\n\x00")
+        traffic = mock.traffic("bench", rate=rate, users=users, churn=churn, duration=seconds)
+        data = bytearray()
+        sock.settimeout(0.5)
+        while not traffic.done.is_set():
+            try:
+                data += sock.recv(65536)
+            except socket.timeout:
+                pass
+        sock.close()
+    with open(path, "wb") as f:
+        f.write(data)
+    print("recorded %d bytes, %d frames to %s" % (len(data), data.count(b"\x00"), path))
+
+
+def frame_type(frames, n):
+    """Type of the frame at n, a b frame followed by its u frame counts as one b+u."""
+    cmd = frames[n].split(":", 1)[0]
+    if cmd == "b" and n + 1 < len(frames) and frames[n + 1].startswith("u:"):
+        return "b+u", 2
+    return cmd, 1
+
+
+def group_frames(frames, types=("b+u", "participant", "g_participants", "i", "n")):
+    """Split frames into lists of frames by type."""
+    groups = collections.OrderedDict((t, list()) for t in types)
+    n = 0
+    while n < len(frames):
+        cmd, size = frame_type(frames, n)
+        if cmd in groups:
+            groups[cmd].append(frames[n:n + size])
+        n += size
+    return groups
+
+
+def run_case(results, name, one, items, setup=lambda: None, number=None):
+    """
+    Time and trace one operation over a list of inputs.
+
+    Reports the best time of five runs, plus the memory the operation
+    needs while it runs (peak) and keeps afterwards (retained). Without
+    a number, each run repeats the batch for about 0.2 seconds.
+    """
+    if not items:
+        return
+    consume = collections.deque(maxlen=0).extend
+
+    def batch():
+        consume(map(one, items))
+
+    timer = timeit.Timer(batch, setup=setup)
+    setup()
+    number = number or timer.autorange()[0]
+    best = min(timer.repeat(number=number, repeat=5)) / (number * len(items))
+
+    # peak of single operations, then what a whole batch leaves behind
+    setup()
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    for item in items[:200]:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        one(item)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    setup()
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    batch()
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    gc.collect()
+    blocks = sys.getallocatedblocks() - blocks
+
+    results[name] = {
+        "usPerOp": best * 1e6,
+        "opsPerSec": 1 / best,
+        "peakBytes": peak,
+        "retainedBytesPerOp": retained / len(items),
+        "retainedBlocksPerOp": blocks / len(items),
+    }
+    print("%-30s %8.2f us/op %11.0f op/s %8d B peak %8.1f B/op kept %6.2f blocks/op kept" % (
+        name, best * 1e6, 1 / best, peak, retained / len(items), blocks / len(items)))
+
+
+def bench_hotpath(frames=None):
+    """
+    Benchmark what every received frame goes through, by frame type.
+
+    No handlers are overridden, so this measures the library and not a bot.
+    """
+    frames = frames or synthetic_frames()
+    groups = group_frames(frames)
+    print("== inbound hot path (%d frames: %s) ==" % (
+        len(frames), ", ".join("%d %s" % (len(li), t) for t, li in groups.items())))
+    results = collections.OrderedDict()
+    mgr = ch.RoomManager(pm=False)
+    room = BenchRoom("benchroom", mgr=mgr)
+
+    def reset():
+        room.userlist.clear()
+        room.mqueue.clear()
+        room.i_log = list()
+
+    # whole stream, then each frame type through feed and _process
+    data = b"".join(frame.encode() + b"\r\n\x00" for frame in frames)
+    chunks = [data[n:n + 4096] for n in range(0, len(data), 4096)]
+    run_case(results, "feed (stream, per 4KiB)", room.feed, chunks, reset)
+    for cmd, items in groups.items():
+        encoded = [b"".join(frame.encode() + b"\r\n\x00" for frame in item) for item in items]
+        run_case(results, "feed %s" % cmd, room.feed, encoded, reset)
+    process = room._process
+    for cmd, items in groups.items():
+        run_case(results, "_process %s" % cmd, lambda item: [process(frame) for frame in item], items, reset)
+
+    # the handlers themselves
+    pairs = [(b.split(":", 10)[1:], u.split(":")[1:]) for b, u in groups["b+u"]]
+    rcmd_b, rcmd_u = room._rcmd_b, room._rcmd_u
+    run_case(results, "_rcmd_b+_rcmd_u", lambda p: (rcmd_b(*p[0]), rcmd_u(*p[1])), pairs, reset)
+    parts = [item[0].split(":")[1:] for item in groups["participant"]]
+    rcmd_participant = room._rcmd_participant
+    run_case(results, "_rcmd_participant", lambda args: rcmd_participant(*args), parts, reset)
+    gparts = [item[0].split(":", 1)[1:] for item in groups["g_participants"]]
+    rcmd_g_participants = room._rcmd_g_participants
+    run_case(results, "_rcmd_g_participants", lambda args: rcmd_g_participants(*args), gparts, reset)
+
+    # helpers they call
+    run_case(results, "clean_message", ch.clean_message, SAMPLES * 20)
+    rooms = ["room%dname%d" % (i, i * 7919 % 1000) for i in range(2000)]
+    run_case(results, "getServerNum", ch.getServerNum, rooms)
+    names = ["user%d" % i for i in range(2000)]
+    keep = [ch.User(name) for name in names]
+    run_case(results, "ch.User() lookup", ch.User, names)
+    msgs = list()
+    for i in range(1000):
+        msg = room._makeMessage("1412345678.5", names[i % 200], "", "12345678", "unid", "1.2.3.4", "0",
+                                SAMPLES[i % len(SAMPLES)])
+        msg.attach(str(5000000 + i))
+        msgs.append(msg)
+    run_case(results, "_addHistory", room._addHistory, msgs)
+    del keep
+    mgr.close()
+    return results
+
+
+def save_results(path, results, source):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "meta": {
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "implementation": platform.python_implementation(),
+                "platform": platform.platform(),
+                "frames": source,
+            },
+            "results": results,
+        }, f, indent=1)
+    print("saved results to %s" % path)
+
+
+def compare_results(base, new):
+    """Print how new compares to base, per case."""
+    print("== compared to %s (%s) ==" % (base["meta"]["date"], base["meta"]["frames"]))
+    for name, now in new["results"].items():
+        old = base["results"].get(name)
+        if old is None:
+            print("%-30s %8.2f us/op        (new)" % (name, now["usPerOp"]))
+            continue
+        print("%-30s %8.2f -> %8.2f us/op %+7.1f%%  %8.1f -> %8.1f B/op kept" % (
+            name, old["usPerOp"], now["usPerOp"], (now["usPerOp"] / old["usPerOp"] - 1) * 100,
+            old["retainedBytesPerOp"], now["retainedBytesPerOp"]))
+
+
+SUITES = ["messages", "memory", "servers", "registry", "reconnect", "hotpath"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for ch.")
+    parser.add_argument("suites", nargs="*", help="suites to run, all by default: %s" % ", ".join(SUITES))
+    parser.add_argument("--frames", help="replay frames recorded with --record instead of synthetic ones")
+    parser.add_argument("--record", metavar="FILE", help="record frames from a busy mock room and exit")
+    parser.add_argument("--room", help="record this live room instead of the mock one")
+    parser.add_argument("--seconds", type=float, default=5.0, help="seconds to record for (%(default)s)")
+    parser.add_argument("--json", metavar="FILE", help="save the hot path results")
+    parser.add_argument("--compare", metavar="FILE", nargs="+",
+                        help="compare the hot path results to a saved run, or two saved runs to each other")
+    args = parser.parse_args()
+    for suite in args.suites:
+        if suite not in SUITES:
+            parser.error("unknown suite %r, choose from %s" % (suite, ", ".join(SUITES)))
+
+    if args.record:
+        record_frames(args.record, args.seconds, room=args.room)
+        return
+    if args.compare and len(args.compare) == 2:
+        runs = list()
+        for path in args.compare:
+            with open(path, encoding="utf-8") as f:
+                runs.append(json.load(f))
+        compare_results(*runs)
+        return
+
+    suites = args.suites or SUITES
+    frames = load_frames(args.frames) if args.frames else None
+    if "messages" in suites:
+        bench_messages(message_bodies(frames) if frames else None)
+    if "memory" in suites:
+        bench_memory()
+    if "servers" in suites:
+        bench_servers()
+    if "registry" in suites:
+        stress_registry()
+    if "reconnect" in suites:
+        check_reconnect()
+    if "hotpath" in suites or args.json or args.compare:
+        results = bench_hotpath(frames)
+        source = args.frames or "synthetic"
+        if args.json:
+            save_results(args.json, results, source)
+        if args.compare:
+            with open(args.compare[0], encoding="utf-8") as f:
+                base = json.load(f)
+            compare_results(base, {"meta": {}, "results": results})
+
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,22 @@
 # Imports
 ################################################################
 # import asyncio
+import bisect
+import collections
 import random
 import html
+import json
+import os
 import re
+import threading
 
 # import sys
+import ch.auth
 import ch.common
+import ch.history
+import ch.ratelimit
+import ch.reconnect
+import ch.userlist
 
 ################################################################
 # Debug stuff
@@ -30,39 +40,177 @@ debug = __debug__
 ################################################################
 # Tagserver stuff
 ################################################################
-specials = {'mitvcanal': 56, 'animeultimacom': 34, 'cricket365live': 21, 'pokemonepisodeorg': 22, 'animelinkz': 20,
-            'sport24lt': 56, 'narutowire': 10, 'watchanimeonn': 22, 'cricvid-hitcric-': 51, 'narutochatt': 70,
-            'leeplarp': 27, 'stream2watch3': 56, 'ttvsports': 56, 'ver-anime': 8, 'vipstand': 21, 'eafangames': 56,
-            'soccerjumbo': 21, 'myfoxdfw': 67, 'kiiiikiii': 21, 'de-livechat': 5, 'rgsmotrisport': 51,
-            'dbzepisodeorg': 10, 'watch-dragonball': 8, 'peliculas-flv': 69, 'tvanimefreak': 54, 'tvtvanimefreak': 54}
-tsweights = [['5', 75], ['6', 75], ['7', 75], ['8', 75], ['16', 75], ['17', 75], ['18', 75], ['9', 95], ['11', 95],
-             ['12', 95], ['13', 95], ['14', 95], ['15', 95], ['19', 110], ['23', 110], ['24', 110], ['25', 110],
-             ['26', 110], ['28', 104], ['29', 104], ['30', 104], ['31', 104], ['32', 104], ['33', 104], ['35', 101],
-             ['36', 101], ['37', 101], ['38', 101], ['39', 101], ['40', 101], ['41', 101], ['42', 101], ['43', 101],
-             ['44', 101], ['45', 101], ['46', 101], ['47', 101], ['48', 101], ['49', 101], ['50', 101], ['52', 110],
-             ['53', 110], ['55', 110], ['57', 110], ['58', 110], ['59', 110], ['60', 110], ['61', 110], ['62', 110],
-             ['63', 110], ['64', 110], ['65', 110], ['66', 110], ['68', 95], ['71', 116], ['72', 116], ['73', 116],
-             ['74', 116], ['75', 116], ['76', 116], ['77', 116], ['78', 116], ['79', 116], ['80', 116], ['81', 116],
-             ['82', 116], ['83', 116], ['84', 116]]
+weightsFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tsweights.json")
+weightsFormat = 1
+
+specials = dict()
+tsweights = list()
+weightsVersion = None
 
 wgts = []
+maxnum = 0
+
+serverCacheSize = 4096  # rooms whose server gets memoized
 
-maxnum = sum(l[1] for l in tsweights)
-cumfreq = 0
-for nwgt in tsweights:
-    cumfreq += nwgt[1] / maxnum
-    wgts.append((cumfreq, nwgt[0]))
+_servers = collections.OrderedDict()  # room -> hostname, least recently used first
+# (tsweights, specials, upper bound of each server in wgts, server numbers, special room -> hostname,
+#  hostname of each server plus the last one again, for lookups past the last bound) swapped as a whole
+_serverSource = (None, None, [], [], {}, [])
+_serverLock = threading.Lock()
 
 
 # noinspection PyPep8Naming
-def getServerNum(group):
+def updateWeights(weights=None, specialRooms=None, version=None):
+    """
+    Replace the server weights and/or the special rooms, and rebuild the lookup tables.
+
+    Reassigning ch.tsweights or ch.specials gets picked up on its own,
+    call this after changing them in place. Lookups running meanwhile
+    see either the old or the new tables, never a mix.
+
+    @type weights: list
+    @param weights: [[server number, weight], ...]
+
+    @type specialRooms: dict
+    @param specialRooms: room name -> server number
+
+    @type version: str
+    @param version: version of the weights, for reference
+    """
+    global tsweights, specials, weightsVersion, wgts, maxnum, _serverSource
+    with _serverLock:
+        weights = tsweights if weights is None else weights
+        specialRooms = specials if specialRooms is None else specialRooms
+        total = sum(l[1] for l in weights)
+        cumfreq = 0
+        table = list()
+        for nwgt in weights:
+            cumfreq += nwgt[1] / total
+            table.append((cumfreq, nwgt[0]))
+        hosts = ["s" + str(s) + ".chatango.com" for wgt, s in table]
+        source = (weights, specialRooms, [wgt for wgt, s in table], [s for wgt, s in table],
+                  {room: "s" + str(sn) + ".chatango.com" for room, sn in specialRooms.items() if sn},
+                  hosts + hosts[-1:])
+        tsweights, specials, wgts, maxnum = weights, specialRooms, table, total
+        if version is not None:
+            weightsVersion = version
+        _serverSource = source
+        _servers.clear()
+
+
+# noinspection PyPep8Naming
+def readWeights(path=None):
+    """
+    Read a weights file.
+
+    @type path: str
+    @param path: the file, ch.weightsFile if not given
+
+    @rtype: tuple
+    @return: (weights, specials, version)
+    """
+    with open(path or weightsFile, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("format") != weightsFormat:
+        raise ValueError("unsupported weights file format: %r" % data.get("format"))
+    weights = [[str(sn), int(weight)] for sn, weight in data["weights"]]
+    specialRooms = {room: int(sn) for room, sn in data["specials"].items()}
+    if not weights:
+        raise ValueError("no server weights in %s" % (path or weightsFile))
+    return weights, specialRooms, data.get("version")
+
+
+# noinspection PyPep8Naming
+def loadWeights(path=None):
+    """
+    Load the weights and special rooms from a file, replacing the current ones at once.
+
+    Nothing changes if the file can't be read.
+
+    @type path: str
+    @param path: the file, ch.weightsFile if not given
+
+    @rtype: str
+    @return: version of the loaded weights
+    """
+    weights, specialRooms, version = readWeights(path)
+    updateWeights(weights, specialRooms, version)
+    return version
+
+
+# noinspection PyPep8Naming
+def writeWeights(weights, specialRooms, version, path=None):
+    """
+    Write a weights file, atomically replacing the old one.
+
+    @type weights: list
+    @param weights: [[server number, weight], ...]
+
+    @type specialRooms: dict
+    @param specialRooms: room name -> server number
+
+    @type version: str
+    @param version: version of the weights
+
+    @type path: str
+    @param path: the file, ch.weightsFile if not given
+    """
+    path = path or weightsFile
+    lines = ["{",
+             ' "format": %d,' % weightsFormat,
+             ' "version": %s,' % json.dumps(version),
+             ' "weights": [',
+             ",\n".join("  " + json.dumps([str(sn), int(weight)]) for sn, weight in weights),
+             " ],",
+             ' "specials": {',
+             ",\n".join("  %s: %d" % (json.dumps(room), int(sn)) for room, sn in sorted(specialRooms.items())),
+             " }",
+             "}\n"]
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    os.replace(tmp, path)
+
+
+def _serverNum(source, group):
     group = group.replace("_", "q")
     group = group.replace("-", "q")
     lnv = int(group[6:9] or 'rs', 36)
     num = (int(group[:5], 36) % lnv) / lnv
-    for wgt, s in wgts:
-        if num <= wgt:
-            return s
+    cumweights, nums = source[2:4]
+    return nums[min(bisect.bisect_left(cumweights, num), len(nums) - 1)]
+
+
+def _lookupServer(source, group):
+    host = source[4].get(group)
+    if host is None:
+        # same as _serverNum, inlined, this is the uncached path of every lookup
+        num = group.replace("_", "q").replace("-", "q")
+        lnv = int(num[6:9] or 'rs', 36)
+        host = source[5][bisect.bisect_left(source[2], (int(num[:5], 36) % lnv) / lnv)]
+    return host
+
+
+# noinspection PyPep8Naming
+def getServerNum(group):
+    return _serverNum(_currentSource(), group)
+
+
+def _currentSource():
+    source = _serverSource
+    if source[0] is not tsweights or source[1] is not specials:
+        updateWeights()
+        source = _serverSource
+    return source
+
+
+def _memoizeServers(source, found):
+    with _serverLock:
+        if _serverSource is not source:  # rebuilt meanwhile, these may be stale
+            return
+        _servers.update(found)
+        while len(_servers) > serverCacheSize:
+            _servers.popitem(last=False)
 
 
 # noinspection PyPep8Naming
@@ -76,8 +224,54 @@ def getServer(group):
       @rtype: str
       @return: the server's hostname
       """
-    sn = specials.get(group) or getServerNum(group)
-    return "s" + str(sn) + ".chatango.com"
+    source = _serverSource
+    if source[0] is not tsweights or source[1] is not specials:
+        source = _currentSource()
+    host = _servers.get(group)
+    if host is None:
+        host = _lookupServer(source, group)
+        if serverCacheSize > 0:
+            _memoizeServers(source, ((group, host),))
+        return host
+    try:
+        _servers.move_to_end(group)
+    except KeyError:  # evicted meanwhile
+        pass
+    return host
+
+
+# noinspection PyPep8Naming
+def getServers(groups):
+    """
+      Get the server hosts for many rooms at once.
+
+      @type groups: [str, ...]
+      @param groups: room names
+
+      @rtype: [str, ...]
+      @return: the servers' hostnames, in the same order
+      """
+    source = _currentSource()
+    hosts = list()
+    found = dict()
+    for group in groups:
+        host = _servers.get(group)
+        if host is not None:
+            try:
+                _servers.move_to_end(group)
+            except KeyError:  # evicted meanwhile
+                pass
+        else:
+            host = found.get(group)
+            if host is None:
+                host = found[group] = _lookupServer(source, group)
+        hosts.append(host)
+    if found and serverCacheSize > 0:
+        _memoizeServers(source, found)
+    return hosts
+
+
+loadWeights()
 
 
 ################################################################
@@ -93,6 +287,84 @@ def genUid():
 ################################################################
 # Message stuff
 ################################################################
+# one pass over well formed tags: captures the n tag, the f tag and drops any other tag,
+# a "<n" tag not closed by "/>" or a stray bracket is left in the text for _scan to notice
+_tag_re = re.compile(r"<(?:n([^<>\n]*)/>|f([^<>\n]*)>|(?!n)[^<>]*>)")
+# the plain ' xSZCOL="FONT"' form, anything else goes through the old splitting
+_font_re = re.compile(r' x(\d\d)([0-9a-fA-F]{0,3})="([^"]*)"\Z')
+_n_re = re.compile(r"<n(.*?)/>")
+_f_re = re.compile(r"<f(.*?)>")
+
+
+def _scan(msg):
+    if "<" not in msg:
+        return html.unescape(msg), None, None
+    parts = _tag_re.split(msg)
+    text = "".join(parts[::3])
+    if "<" in text or ">" in text:
+        # not well formed, the passes below can match across tags, do them one by one
+        return _scanSlow(msg)
+    n = f = None
+    for n in parts[1::3]:
+        if n is not None:
+            break
+    for f in parts[2::3]:
+        if f is not None:
+            break
+    return html.unescape(text), n, f
+
+
+def _scanSlow(msg):
+    n = _n_re.search(msg)
+    if n:
+        n = n.group(1)
+    f = _f_re.search(msg)
+    if f:
+        f = f.group(1)
+    msg = _n_re.sub("", msg)
+    msg = _f_re.sub("", msg)
+    msg = strip_html(msg)
+    msg = html.unescape(msg)
+    return msg, n, f
+
+
+def scan_message(msg):
+    """
+    Clean a message and parse its tags, well formed messages in a single pass.
+
+    @type msg: str
+    @param msg: the message
+
+    @rtype: str, str, str, str, int
+    @returns: cleaned message, n tag contents, font color, font face, font size
+    """
+    msg, n, f = _scan(msg)
+    if f:
+        return (msg, n) + parseFont(f)
+    return msg, n, None, None, None
+
+
+def scan_style(msg):
+    """
+    Parse only the n and f tags of a message, leaving its text alone.
+
+    @type msg: str
+    @param msg: the message
+
+    @rtype: str, str, str, int
+    @returns: n tag contents, font color, font face, font size
+    """
+    if "<" not in msg:
+        return None, None, None, None
+    n = _n_re.search(msg)
+    if n:
+        n = n.group(1)
+    f = _f_re.search(msg)
+    if f:
+        return (n,) + parseFont(f.group(1))
+    return n, None, None, None
+
+
 def clean_message(msg):
     """
   Clean a message and return the message, n tag and f tag.
@@ -103,17 +375,7 @@ def clean_message(msg):
   @rtype: str, str, str
   @returns: cleaned message, n tag contents, f tag contents
   """
-    n = re.search("<n(.*?)/>", msg)
-    if n:
-        n = n.group(1)
-    f = re.search("<f(.*?)>", msg)
-    if f:
-        f = f.group(1)
-    msg = re.sub("<n.*?/>", "", msg)
-    msg = re.sub("<f.*?>", "", msg)
-    msg = strip_html(msg)
-    msg = html.unescape(msg)
-    return msg, n, f
+    return _scan(msg)
 
 
 def strip_html(msg):
@@ -138,11 +400,16 @@ def parseNameColor(n):
     return n
 
 
-# noinspection PyBroadException
 def parseFont(f):
     """Parses the contents of a f tag and returns color, face and size."""
     # ' xSZCOL="FONT"'
-    try:  # TODO: remove quick hack
+    if not f:
+        return None, None, None
+    m = _font_re.match(f)
+    if m is not None:
+        size, col, face = m.groups()
+        return col or None, face, int(size)
+    try:
         sizecolor, fontface = f.split("=", 1)
         sizecolor = sizecolor.strip()
         size = int(sizecolor[1:3])
@@ -151,7 +418,7 @@ def parseFont(f):
             col = None
         face = f.split("\"", 2)[1]
         return col, face, size
-    except:
+    except (ValueError, IndexError):
         return None, None, None
 
 
@@ -180,3 +447,7 @@ from ch.roommanager import RoomManager
 from ch.user import User
 # noinspection PyPep8
 from ch.message import Message
+# noinspection PyPep8
+from ch.aio import AsyncRoomManager
+# noinspection PyPep8
+from ch.shard import ShardedRoomManager
@@ -0,0 +1,408 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import asyncio
+import functools
+
+import ch
+
+
+################################################################
+# _Link class
+################################################################
+class _Link(asyncio.Protocol):
+    """
+    Protocol for one transport of a connection.
+
+    Every connect gets a new link, callbacks of a transport the connection
+    already moved on from (closed for a reconnect, or connected too late)
+    get dropped instead of reaching the connection.
+    """
+
+    def __init__(self, con):
+        self.con = con
+
+    def connection_made(self, transport):
+        if self.con.link is self:
+            self.con.connection_made(transport)
+        else:
+            transport.close()
+
+    def data_received(self, data):
+        if self.con.link is self:
+            self.con.data_received(data)
+
+    def connection_lost(self, exc):
+        if self.con.link is self:
+            self.con.link = None
+            self.con.connection_lost(exc)
+
+
+################################################################
+# AsyncRoom class
+################################################################
+# noinspection PyPep8Naming
+class AsyncRoom(ch.Room):
+    """Room driven by an asyncio transport instead of a raw socket."""
+
+    def __init__(self, room, uid=None, server=None, port=None, mgr=None):
+        """init, don't overwrite"""
+        self.transport = None
+        self.link = None
+        self.obuf = list()
+        self.joined = mgr.loop.create_future()
+        super().__init__(room, uid=uid, server=server, port=port, mgr=mgr)
+
+    ####
+    # Protocol, called by the current link only
+    ####
+    def connection_made(self, transport):
+        self.transport = transport
+        for data in self.obuf:
+            transport.write(data)
+        self.obuf = list()
+
+    def data_received(self, data):
+        self.feed(data)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._lost()
+        self._setJoined(None)
+
+    ####
+    # Received Commands
+    ####
+    def _rcmd_inited(self):
+        super()._rcmd_inited()
+        self._setJoined(self)
+
+    def _rcmd_denied(self):
+        super()._rcmd_denied()
+        self._setJoined(None)
+
+    ####
+    # Connect/disconnect
+    ####
+    def _open(self):
+        self.link = _Link(self)
+        self.mgr.spawn(self._create_connection(self.link))
+
+    async def _create_connection(self, link):
+        try:
+            async with self.mgr.connect_slots:
+                await asyncio.wait_for(self.mgr.loop.create_connection(lambda: link, self.server, self.port),
+                                       self.mgr.connectTimeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            if link is self.link:
+                self._connectFail(e)
+                self._setJoined(None)
+
+    def _close(self):
+        self.link = None
+        self.obuf = list()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+    def _setJoined(self, result):
+        if not self.joined.done():
+            self.joined.set_result(result)
+
+
+################################################################
+# AsyncPM class
+################################################################
+class AsyncPM(ch.PM):
+    """PM driven by an asyncio transport instead of a raw socket."""
+
+    def __init__(self, mgr):
+        self.transport = None
+        self.link = None
+        self.obuf = list()
+        super().__init__(mgr)
+
+    ####
+    # Protocol, called by the current link only
+    ####
+    def connection_made(self, transport):
+        self.transport = transport
+        for data in self.obuf:
+            transport.write(data)
+        self.obuf = list()
+
+    def data_received(self, data):
+        self.feed(data)
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._lost()
+
+    ####
+    # Connections
+    ####
+    def _connect(self):
+        self._setWriteLock(True)
+        self.mgr.spawn(self._aconnect())
+
+    async def _aconnect(self):
+        loop = self.mgr.loop
+        link = self.link = _Link(self)
+        self._auid = await loop.run_in_executor(None, self._getToken)
+        if link is not self.link:  # disconnected meanwhile
+            return
+        if self._auid is None:
+            self._loginFailed(self._attempt)
+            return
+        self._wbuf = b""
+        self._rbuf = ch.common.Framer()
+        try:
+            await loop.create_connection(lambda: link, self.mgr.PMHost, self.mgr.PMPort)
+        except OSError:
+            if link is self.link:
+                self._loginFailed(self._attempt)
+            return
+        if link is not self.link:
+            return
+        self._login()
+        self.pingTask = self.mgr.setInterval(self.mgr.pingDelay, self.ping)
+        self.connected = True
+
+    def _close(self):
+        self.link = None
+        self.obuf = list()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+
+
+################################################################
+# AsyncRoomManager class
+################################################################
+class AsyncRoomManager(ch.RoomManager):
+    """
+    RoomManager running every connection and timer on a single asyncio loop.
+
+    Event handlers may be plain functions or coroutine functions, coroutines
+    returned by handlers and tasks get scheduled on the loop.
+    """
+    ####
+    # Config
+    ####
+    Room = AsyncRoom
+    PM = AsyncPM
+
+    ####
+    # Init
+    ####
+    # noinspection PyMissingConstructor
+    def __init__(self, name=None, password=None, pm=True):
+        # no reactor threads or selector, the loop drives everything
+        self._setup(name, password)
+        self.loop = None
+        self.pm = None
+        self.use_pm = pm
+        self.stopped = None
+        self.pending = set()
+        self.connect_slots = asyncio.Semaphore(self.connectConcurrency)
+
+    ####
+    # Util
+    ####
+    def register(self, con):
+        pass
+
+    def unregister(self, con):
+        pass
+
+    def write(self, con, data):
+        if con.transport is not None:
+            con.transport.write(data)
+        else:
+            con.obuf.append(data)
+
+    def spawn(self, ret):
+        """
+        Schedule ret on the loop if it is a coroutine.
+
+        @param ret: return value of a handler
+
+        @rtype: asyncio.Task
+        @return: the task, or None if ret wasn't a coroutine
+        """
+        if asyncio.iscoroutine(ret):
+            task = self.loop.create_task(ret)
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            return task
+
+    def callEvent(self, room, evt, *args, **kw):
+        self.spawn(getattr(self, evt)(room, *args, **kw))
+        self.spawn(self.onEventCalled(room, evt, *args, **kw))
+
+    def getConnections(self):
+        li = list(self.rooms.values())
+        if self.pm and self.pm.connected:
+            li.append(self.pm)
+        return li
+
+    ####
+    # Main
+    ####
+    async def start(self, rooms=()):
+        """
+        Connect and run until stop is called.
+
+        @type rooms: list
+        @param rooms: rooms to join
+        """
+        self.loop = asyncio.get_running_loop()
+        self.stopped = self.loop.create_future()
+        self.spawn(self.onInit())
+        self.running = True
+        if self.use_pm:
+            self.pm = self.PM(mgr=self)
+        await asyncio.gather(*(self.joinRoom(room) for room in rooms))
+        self.spawn(self.onFinishStartup())
+        await self.stopped
+
+    def main(self, rooms=()):
+        asyncio.run(self.start(rooms))
+
+    @classmethod
+    def easy_start(cls, rooms=None, name=None, password=None, pm=True):
+        """
+        Prompts the user for missing info, then starts.
+
+        @type rooms: list
+        @param rooms: rooms to join
+
+        @type name: str
+        @param name: name to join as ("" = None, None = unspecified)
+
+        @type password: str
+        @param password: password to join with ("" = None, None = unspecified)
+
+        @type pm: bool
+        @param pm: whether to connect to pm
+        """
+        rooms, name, password = ch.common.prompt_login(rooms, name, password)
+        self = cls(name, password, pm=pm)
+        self.main(rooms)
+
+    def stop(self):
+        self.running = False
+        self.reconnector.clear()
+        for conn in self.getConnections():
+            conn.disconnect()
+        if self.stopped and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    def close(self):
+        pass
+
+    ####
+    # Scheduling
+    ####
+    def _run(self, task):
+        if task.isInterval:
+            task.handle = self.loop.call_later(task.timeout, self._run, task)
+        self.spawn(task.func(*task.args, **task.kw))
+
+    def setTimeout(self, timeout, func, *args, **kw):
+        """
+        Call a function after at least timeout seconds with specified arguments.
+
+        @type timeout: int
+        @param timeout: timeout
+
+        @type func: function
+        @param func: function to call
+
+        @rtype: _Task
+        @return: object representing the task
+        """
+        task = self._Task(self, False, timeout, func, *args, **kw)
+        task.handle = self.loop.call_later(timeout, self._run, task)
+        return task
+
+    def setInterval(self, timeout, func, *args, **kw):
+        """
+        Call a function at least every timeout seconds with specified arguments.
+
+        @type timeout: int
+        @param timeout: timeout
+        @type func: function
+        @param func: function to call
+
+        @rtype: _Task
+        @return: object representing the task
+        """
+        task = self._Task(self, True, timeout, func, *args, **kw)
+        task.handle = self.loop.call_later(timeout, self._run, task)
+        return task
+
+    def removeTask(self, task):
+        """
+        Cancel a task.
+
+        @type task: _Task
+        @param task: task to cancel
+        """
+        task.handle.cancel()
+
+    ####
+    # Deferring
+    ####
+    def deferToThread(self, callback, func, *args, **kw):
+        """
+        Defer a function to the loop's executor and callback the return value on the loop.
+
+        @type callback: function
+        @param callback: function to call on completion
+
+        @type func: function
+        @param func: function to call
+
+        @param args: arguments to get supplied to the callback
+        @param kw: arguments to get supplied to the callback
+        """
+        future = self.loop.run_in_executor(None, functools.partial(func, *args, **kw))
+        future.add_done_callback(lambda f: self.spawn(callback(f.result())))
+
+    ####
+    # Join/leave
+    ####
+    async def joinRoom(self, room, callback=lambda x: None):
+        """
+        Join a room and wait until it is inited.
+
+        @type room: str
+        @param room: room to join
+
+        @type callback: func
+        @param callback: function to call with the room name
+
+        @rtype: Room
+        @return: the room, or None if the connection failed
+        """
+        room = room.lower()
+        con = self.rooms.get(room)
+        if con is None:
+            con = self.Room(room, mgr=self)
+            self.rooms[room] = con
+            callback(room)
+        return await con.joined
@@ -0,0 +1,154 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import json
+import os
+import threading
+import time
+
+
+################################################################
+# TokenCache class
+################################################################
+class TokenCache:
+    """
+    Auth tokens from the login page, by login url and account name.
+
+    Kept in memory and, if a path is given, in a file readable by its
+    owner only, so restarts and reconnects don't need to log in again.
+    Tokens are dropped once expired or when the server denies them.
+    """
+
+    margin = 60  # seconds before its expiry a token stops being handed out
+
+    ####
+    # Init
+    ####
+    def __init__(self, path=None):
+        """
+        @type path: str
+        @param path: file to persist the tokens in, None to keep them in memory only
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.tokens = dict()  # key -> [auth, expiry timestamp or None]
+        if path:
+            self._load()
+
+    ####
+    # Util
+    ####
+    @staticmethod
+    def _key(url, name):
+        return "%s@%s" % ((name or "").lower(), url)
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.tokens = {key: list(value) for key, value in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            self.tokens = dict()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.tokens, f)
+        os.replace(tmp, self.path)
+
+    ####
+    # Tokens
+    ####
+    def get(self, url, name):
+        """
+        Get a token that hasn't expired.
+
+        @type url: str
+        @param url: login url the token came from
+        @type name: str
+        @param name: account name
+
+        @rtype: str
+        @return: the token, or None
+        """
+        with self.lock:
+            token = self.tokens.get(self._key(url, name))
+            if token is None:
+                return None
+            auth, expires = token
+            if expires is not None and expires - self.margin <= time.time():
+                del self.tokens[self._key(url, name)]
+                self._save()
+                return None
+            return auth
+
+    def put(self, url, name, auth, expires=None):
+        """
+        Store a token.
+
+        @type url: str
+        @param url: login url the token came from
+        @type name: str
+        @param name: account name
+        @type auth: str
+        @param auth: the token
+        @type expires: float
+        @param expires: unix time it expires at, None if unknown
+        """
+        with self.lock:
+            self.tokens[self._key(url, name)] = [auth, expires]
+            self._save()
+
+    def drop(self, url, name):
+        """
+        Forget a token, the next login fetches a new one.
+
+        @type url: str
+        @param url: login url the token came from
+        @type name: str
+        @param name: account name
+        """
+        with self.lock:
+            if self.tokens.pop(self._key(url, name), None) is not None:
+                self._save()
+
+
+################################################################
+# Shared caches
+################################################################
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+# noinspection PyPep8Naming
+def getCache(path=None):
+    """
+    Get the token cache for a file, shared by every manager using it.
+
+    @type path: str
+    @param path: file to persist the tokens in, None for the in-memory cache
+
+    @rtype: TokenCache
+    @return: the cache
+    """
+    key = os.path.abspath(path) if path else None
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = TokenCache(key)
+        return cache
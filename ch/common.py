@@ -1,5 +1,6 @@
 import enum
 import functools
+import inspect
 
 ################################################################
 # Constants
@@ -72,9 +73,12 @@ class Perm(int):
 class DummyConnection:
     name = "#dummy"  # room can't start with '#' on chatango
 
-    def __init__(self):
+    def __init__(self, mgr=None):
+        self.mgr = mgr
         self.sock_pair = socket.socketpair()
         self.sock = self.sock_pair[0]
+        if self.mgr:
+            self.mgr.register(self)
 
     # noinspection PyUnusedLocal
     def recv(self, num):
@@ -89,6 +93,96 @@ class DummyConnection:
     def disconnect(self):
         pass
 
+    def _lost(self):
+        pass
+
+    def close(self):
+        for sock in self.sock_pair:
+            sock.close()
+
+
+class Framer:
+    """Splits a byte stream into \\x00 terminated frames, decoding only complete ones."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.scanned = 0  # bytes already known not to contain \x00
+
+    def feed(self, data):
+        """
+        Add received data.
+
+        @type data: bytes
+        @param data: received data
+
+        @rtype: [str, ...]
+        @return: the frames completed by data
+        """
+        buf = self.buf
+        buf += data
+        end = buf.find(b"\x00", self.scanned)
+        if end == -1:
+            self.scanned = len(buf)
+            return []
+        frames = list()
+        start = 0
+        with memoryview(buf) as view:
+            while end != -1:
+                # \x00 never occurs inside a multibyte utf-8 sequence, so frames decode on their own
+                frames.append(str(view[start:end], 'utf-8', 'replace'))
+                start = end + 1
+                end = buf.find(b"\x00", start)
+        del buf[:start]
+        self.scanned = len(buf)
+        return frames
+
+
+class Dispatcher:
+    """
+    Base for connections, collects the _rcmd_ handlers into a table when a class is created.
+
+    A handler taking *args gets every ":" separated field, any other handler
+    gets the frame split once per parameter so the last one keeps the rest.
+    """
+    rcmds = dict()
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        cls.rcmds = {
+            attr[6:]: (getattr(cls, attr), _maxsplit(getattr(cls, attr)))
+            for attr in dir(cls) if attr.startswith("_rcmd_")
+        }
+
+    def dispatch(self, data):
+        """
+        Call the handler for a command string.
+
+        @type data: str
+        @param data: the command string
+
+        @rtype: bool
+        @return: whether the command has a handler
+        """
+        cmd, sep, rest = data.partition(":")
+        handler = self.rcmds.get(cmd)
+        if handler is None:
+            return False
+        func, maxsplit = handler
+        if sep and maxsplit is not None:
+            func(self, *rest.split(":", maxsplit))
+        else:
+            func(self)
+        return True
+
+
+def _maxsplit(func):
+    params = list(inspect.signature(func, follow_wrapped=False).parameters.values())[1:]
+    if any(param.kind == param.VAR_POSITIONAL for param in params):
+        return -1
+    if not params:
+        return None
+    return len(params) - 1
+
 
 def resplit(new, old=":"):
     def decorator(func):
@@ -124,4 +218,33 @@ def grouper(number):
         def internal(cls, *args):
             func(cls, zip(*([iter(args)]*number)))
         return internal
-    return decorator
\ No newline at end of file
+    return decorator
+
+
+def prompt_login(rooms=None, name=None, password=None):
+    """
+    Prompt for what easy_start wasn't given.
+
+    @type rooms: list
+    @param rooms: rooms to join
+    @type name: str
+    @param name: name to join as ("" = None, None = unspecified)
+    @type password: str
+    @param password: password to join with ("" = None, None = unspecified)
+
+    @rtype: tuple
+    @return: rooms, name, password
+    """
+    if rooms is None:
+        rooms = str(input("Room names separated by semicolons: ")).split(";")
+    if len(rooms) == 1 and rooms[0] == "":
+        rooms = []
+    if name is None:
+        name = str(input("User name: "))
+    if name == "":
+        name = None
+    if password is None:
+        password = str(input("User password: "))
+    if password == "":
+        password = None
+    return rooms, name, password
@@ -0,0 +1,163 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import collections
+import itertools
+
+
+################################################################
+# History class
+################################################################
+class History:
+    """
+    Bounded message history, the oldest messages get evicted once full.
+
+    Messages are kept in arrival order with an index by mid and by user,
+    so append, evict, delete, lookup by mid and last message by user
+    are all O(1). Iterates oldest first like the list it replaces.
+    """
+
+    ####
+    # Init
+    ####
+    def __init__(self, maxlen):
+        """
+        @type maxlen: int
+        @param maxlen: number of messages to keep
+        """
+        self.maxlen = maxlen
+        self.msgs = collections.OrderedDict()  # msg -> None, oldest first
+        self.mids = dict()  # mid -> msg
+        self.users = dict()  # user -> OrderedDict of msg -> None, oldest first
+
+    ####
+    # Util
+    ####
+    def _unindex(self, msg):
+        if self.mids.get(msg.mid) is msg:
+            del self.mids[msg.mid]
+        msgs = self.users.get(msg.user)
+        if msgs is not None:
+            msgs.pop(msg, None)
+            if not msgs:
+                del self.users[msg.user]
+
+    ####
+    # Modify
+    ####
+    def append(self, msg):
+        """
+        Add a message.
+
+        @type msg: Message
+        @param msg: message
+
+        @rtype: [Message, ...]
+        @return: the messages evicted to make room
+        """
+        self.msgs[msg] = None
+        if msg.mid is not None:
+            self.mids[msg.mid] = msg
+        msgs = self.users.get(msg.user)
+        if msgs is None:
+            msgs = self.users[msg.user] = collections.OrderedDict()
+        msgs[msg] = None
+        evicted = list()
+        while len(self.msgs) > self.maxlen:
+            old = self.msgs.popitem(last=False)[0]
+            self._unindex(old)
+            evicted.append(old)
+        return evicted
+
+    def remove(self, msg):
+        """
+        Remove a message, raises KeyError if it isn't in the history.
+
+        @type msg: Message
+        @param msg: message
+        """
+        del self.msgs[msg]
+        self._unindex(msg)
+
+    def clear(self):
+        self.msgs.clear()
+        self.mids.clear()
+        self.users.clear()
+
+    ####
+    # Lookup
+    ####
+    def get(self, mid):
+        """
+        Get a message by mid.
+
+        @type mid: str
+        @param mid: message id
+
+        @rtype: Message
+        @return: the message, or None if it isn't in the history
+        """
+        return self.mids.get(mid)
+
+    def last(self, user=None):
+        """
+        Get the latest message, of a user if one is given.
+
+        @type user: User
+        @param user: only look at this user's messages
+
+        @rtype: Message
+        @return: the message, or None if there is none
+        """
+        msgs = self.msgs if user is None else self.users.get(user)
+        if not msgs:
+            return None
+        return next(reversed(msgs))
+
+    def recent(self, count):
+        """
+        Get the latest messages.
+
+        @type count: int
+        @param count: how many
+
+        @rtype: [Message, ...]
+        @return: up to count messages, oldest first
+        """
+        li = list(itertools.islice(reversed(self.msgs), count))
+        li.reverse()
+        return li
+
+    ####
+    # Sequence
+    ####
+    def __len__(self):
+        return len(self.msgs)
+
+    def __iter__(self):
+        return iter(self.msgs)
+
+    def __reversed__(self):
+        return reversed(self.msgs)
+
+    def __contains__(self, msg):
+        return msg in self.msgs
+
+    def __getitem__(self, index):
+        return list(self.msgs)[index]
+
+    def __repr__(self):
+        return "<History: %d/%d>" % (len(self.msgs), self.maxlen)
@@ -11,12 +11,27 @@
 # Copyright 2015 asl97 & aqua101
 # This program is distributed under the terms of the GNU AGPL 3
 
+################################################################
+# Imports
+################################################################
+import sys
+
+import ch
+
 
 ################################################################
 # Message class
 ################################################################
+# noinspection PyPep8Naming
 class Message:
-    """Class that represents a message."""
+    """
+    Class that represents a message.
+
+    The body, n and f tags are parsed out of raw on first access.
+    """
+    # __dict__ keeps arbitrary attributes working, it only gets allocated once one is set
+    __slots__ = ("mid", "time", "user", "room", "raw", "ip", "channel", "puid", "unid", "i", "anon",
+                 "_parsed", "_body", "_n", "_nameColor", "_fontColor", "_fontFace", "_fontSize", "__dict__")
 
     ####
     # Attach/detach
@@ -44,23 +59,131 @@ class Message:
     ####
     # Init
     ####
-    def __init__(self, **kw):
+    def __init__(self, mid=None, time=None, user=None, room=None, raw=None, ip=None, channel=None, puid=None,
+                 unid=None, i=None, anon=False, body=None, nameColor=None, fontColor=None, fontFace=None,
+                 fontSize=None):
         """init, don't overwrite"""
-        self.mid = None
-        self.time = None
-        self.user = None
-        self.body = None
-        self.room = None
-        self.raw = ""
-        self.ip = None
-        self.channel = ""
-        self.mid = ""
-        self.puid = ""
-        self.nameColor = "000"
-        self.fontSize = 12
-        self.fontFace = "0"
-        self.fontColor = "000"
-        for attr, val in kw.items():
-            if val is None:
-                continue
-            setattr(self, attr, val)
+        self.mid = mid
+        self.time = time
+        self.user = user
+        self.room = room
+        self.raw = raw or ""
+        self.ip = ip
+        self.channel = channel or ""
+        self.puid = puid or ""
+        self.unid = unid or ""
+        self.i = i
+        self.anon = bool(anon)
+        self._parsed = False
+        self._body = None
+        self._n = None
+        self._nameColor = None
+        self._fontColor = None
+        self._fontFace = None
+        self._fontSize = None
+        # overrides of what raw carries, rare enough to be checked one by one
+        if body is not None:
+            self.body = body
+        if nameColor is not None:
+            self.nameColor = nameColor
+        if fontColor is not None:
+            self.fontColor = fontColor
+        if fontFace is not None:
+            self.fontFace = fontFace
+        if fontSize is not None:
+            self.fontSize = fontSize
+
+    ####
+    # Parsing
+    ####
+    def _parse(self):
+        self._parsed = True
+        self._body, n, fontColor, fontFace, self._fontSize = ch.scan_message(self.raw)
+        # the tags repeat from message to message, keep one copy of each
+        self._n = n and sys.intern(n)
+        self._fontColor = fontColor and sys.intern(fontColor)
+        self._fontFace = fontFace and sys.intern(fontFace)
+        if not self.anon:
+            self._nameColor = ch.parseNameColor(self._n)
+
+    def style(self):
+        """
+        Get the styling carried by the message, None where it carries none.
+
+        @rtype: str, str, str, int
+        @return: name color, font color, font face, font size
+        """
+        if self._parsed:
+            return self._nameColor, self._fontColor, self._fontFace, self._fontSize
+        # only the tags, the text stays unparsed until something reads it
+        n, fontColor, fontFace, fontSize = ch.scan_style(self.raw)
+        return None if self.anon else ch.parseNameColor(n), fontColor, fontFace, fontSize
+
+    ####
+    # Properties
+    ####
+    @property
+    def body(self):
+        if not self._parsed:
+            self._parse()
+        return self._body
+
+    @body.setter
+    def body(self, val):
+        if not self._parsed:
+            self._parse()
+        self._body = val
+
+    @property
+    def n(self):
+        if not self._parsed:
+            self._parse()
+        return self._n
+
+    @property
+    def nameColor(self):
+        if not self._parsed:
+            self._parse()
+        return self._nameColor or "000"
+
+    @nameColor.setter
+    def nameColor(self, val):
+        if not self._parsed:
+            self._parse()
+        self._nameColor = val
+
+    @property
+    def fontColor(self):
+        if not self._parsed:
+            self._parse()
+        return self._fontColor or "000"
+
+    @fontColor.setter
+    def fontColor(self, val):
+        if not self._parsed:
+            self._parse()
+        self._fontColor = val
+
+    @property
+    def fontFace(self):
+        if not self._parsed:
+            self._parse()
+        return self._fontFace or "0"
+
+    @fontFace.setter
+    def fontFace(self, val):
+        if not self._parsed:
+            self._parse()
+        self._fontFace = val
+
+    @property
+    def fontSize(self):
+        if not self._parsed:
+            self._parse()
+        return self._fontSize or 12
+
+    @fontSize.setter
+    def fontSize(self, val):
+        if not self._parsed:
+            self._parse()
+        self._fontSize = val
@@ -0,0 +1,605 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import asyncio
+import collections
+import itertools
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+
+
+################################################################
+# Util
+################################################################
+def _frame(*args):
+    return ":".join(str(arg) for arg in args).encode() + b"\r\n\x00"
+
+
+class _Protocol(asyncio.Protocol):
+    """Splits the client's \\x00 terminated frames into arguments."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buf = bytearray()
+        self.first = True
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buf += data
+        while True:
+            end = self.buf.find(b"\x00")
+            if end < 0:
+                return
+            frame = self.buf[:end].decode("utf-8", "replace").strip("\r\n")
+            del self.buf[:end + 1]
+            first, self.first = self.first, False
+            if frame:
+                self.server.framesIn[frame.split(":", 1)[0]] += 1
+                self.received(frame.split(":"), first)
+
+    def send(self, *args):
+        if self.transport is not None and not self.transport.is_closing():
+            self.server.framesOut[str(args[0])] += 1
+            self.transport.write(_frame(*args))
+
+    def received(self, args, first):
+        """
+        Handle a frame from the client, the base ignores every frame.
+
+        @type args: list
+        @param args: the frame split on ":"
+
+        @type first: bool
+        @param first: whether it is the first frame of the connection, which has no \\r\\n
+        """
+
+
+################################################################
+# Rooms
+################################################################
+# noinspection PyPep8Naming
+class MockRoom:
+    """A room of the mock tag server, with virtual users that can be scripted to talk and come and go."""
+
+    def __init__(self, server, name, owner="owner", historySize=1000):
+        self.server = server
+        self.name = name
+        self.owner = owner
+        self.mods = dict()  # name -> perm
+        self.conns = set()
+        self.users = dict()  # lowercased name -> (sid, puid, ctime, name) of virtual users
+        self.history = collections.deque(maxlen=historySize)
+        self.i = itertools.count(1)
+        self.mid = itertools.count(1000000)
+        self.sid = itertools.count(1)
+
+    ####
+    # Frames
+    ####
+    def broadcast(self, *args):
+        for conn in list(self.conns):
+            conn.send(*args)
+
+    def participants(self):
+        li = ["%s:%s:%s:%s:None:x" % (sid, ctime, puid, name) for sid, puid, ctime, name in self.users.values()]
+        li.extend("%s:%s:%s:%s:None:x" % (conn.sid, conn.ctime, conn.puid, conn.name)
+                  for conn in self.conns if conn.name)
+        return li
+
+    def count(self):
+        return len(self.users) + len(self.conns)
+
+    ####
+    # Scripting, only call these on the server loop (see MockChatango.call)
+    ####
+    def post(self, name, body, channel="0", puid=None, raw=False):
+        """
+        Send a message to the room.
+
+        @type name: str
+        @param name: sender, "" for an anon
+        @type body: str
+        @param body: message
+        @type raw: bool
+        @param raw: body already has the n and f tags
+        """
+        if not raw:
+            body = '<n000/><f x12000="0">' + body
+        puid = puid or str(random.randint(10000000, 99999999))
+        mtime = "%.2f" % time.time()
+        i = str(next(self.i))
+        mid = str(next(self.mid))
+        self.history.append((mtime, name, "", puid, "unid" + puid, mid, "127.0.0.1", channel, body))
+        self.broadcast("b", mtime, name, "", puid, "unid" + puid, i, "127.0.0.1", channel, "", body)
+        self.broadcast("u", i, mid)
+        return mid
+
+    def join(self, name, puid=None):
+        """Add a virtual user."""
+        if name.lower() in self.users:
+            return
+        sid = str(next(self.sid))
+        puid = puid or str(random.randint(10000000, 99999999))
+        ctime = "%.2f" % time.time()
+        self.users[name.lower()] = (sid, puid, ctime, name)
+        self.broadcast("participant", "1", sid, puid, name, "None", "x", ctime)
+        self.broadcast("n", "%x" % self.count())
+
+    def leave(self, name):
+        """Remove a virtual user."""
+        user = self.users.pop(name.lower(), None)
+        if user is None:
+            return
+        sid, puid, ctime, name = user
+        self.broadcast("participant", "0", sid, puid, name, "None", "x", "%.2f" % time.time())
+        self.broadcast("n", "%x" % self.count())
+
+    def delete(self, mid):
+        """Delete a message."""
+        for msg in list(self.history):
+            if msg[5] == mid:
+                self.history.remove(msg)
+        self.broadcast("delete", mid)
+
+    def kick(self):
+        """Drop every client connection, like a tag server restart."""
+        for conn in list(self.conns):
+            conn.transport.close()
+
+    def floodWarning(self):
+        self.broadcast("show_fw")
+
+    def floodBan(self, seconds):
+        self.broadcast("show_tb", seconds)
+
+
+class _RoomConnection(_Protocol):
+    """A client of the mock tag server."""
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.room = None
+        self.name = None
+        self.puid = None
+        self.sid = None
+        self.ctime = None
+        self.sent = 0  # history messages sent so far, for get_more
+
+    def connection_lost(self, exc):
+        self.transport = None
+        room = self.room
+        if room is not None and self in room.conns:
+            room.conns.discard(self)
+            if self.name:
+                room.broadcast("participant", "0", self.sid, self.puid, self.name, "None", "x", "%.2f" % time.time())
+            room.broadcast("n", "%x" % room.count())
+
+    def received(self, args, first):
+        cmd = args[0]
+        if first:
+            if cmd == "bauth":
+                self.auth(*(args[1:] + [""] * 4)[:4])
+            else:
+                self.transport.close()
+        elif self.room is None:
+            return
+        elif cmd == "bm":
+            self.room.post(self.name or "", ":".join(args[3:]), channel=args[2], puid=self.puid, raw=True)
+        elif cmd == "g_participants":
+            self.send("g_participants", ";".join(self.room.participants()))
+        elif cmd == "getpremium":
+            self.send("premium", "210", "0")
+        elif cmd == "blocklist":
+            self.send("blocklist" if args[1] == "block" else "unblocklist", "")
+        elif cmd == "get_more":
+            self.more(int(args[1]), args[2] if len(args) > 2 else "0")
+        elif cmd == "delmsg":
+            self.room.delete(args[1])
+        elif cmd == "blogin":
+            self.name = "#" + args[1] if len(args) < 3 else args[1]
+            self.send("aliasok" if len(args) < 3 else "pwdok")
+        elif cmd == "blogout":
+            self.send("logoutok")
+
+    def auth(self, room, uid, name, password):
+        server = self.server
+        self.room = server.room(room)
+        uid = uid or str(random.randint(10 ** 15, 10 ** 16 - 1))
+        self.puid = uid[:8]
+        self.sid = str(next(self.room.sid))
+        self.ctime = "%.2f" % time.time()
+        if name and password:
+            if not server.checkLogin(name, password):
+                self.send("ok", self.room.owner, uid, "C", "", self.ctime, "127.0.0.1", "", "")
+                self.room = None
+                return
+            self.name, success = name, "M"
+        else:
+            success = "N"
+        mods = ";".join("%s,%d" % (mod, perm) for mod, perm in self.room.mods.items())
+        self.send("ok", self.room.owner, uid, success, name or "", self.ctime, "127.0.0.1", mods, "")
+        self.more(server.historyOnJoin)
+        self.send("inited")
+        self.room.conns.add(self)
+        if self.name:
+            self.room.broadcast("participant", "1", self.sid, self.puid, self.name, "None", "x", self.ctime)
+        self.room.broadcast("n", "%x" % self.room.count())
+
+    def more(self, count, page=None):
+        history = list(self.room.history)
+        end = len(history) - self.sent
+        if end <= 0:
+            if page is not None:
+                self.send("nomore")
+            return
+        batch = history[max(0, end - count):end]
+        for mtime, name, anon, puid, unid, mid, ip, channel, body in reversed(batch):
+            self.send("i", mtime, name, anon, puid, unid, mid, ip, channel, "", body)
+        self.sent += len(batch)
+        if page is not None:
+            self.send("gotmore", page)
+
+
+################################################################
+# PM
+################################################################
+class _PMConnection(_Protocol):
+    """A client of the mock PM server."""
+
+    def __init__(self, server):
+        super().__init__(server)
+        self.name = None
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.name:
+            self.server.pms[self.name.lower()].discard(self)
+
+    def received(self, args, first):
+        server = self.server
+        cmd = args[0]
+        if first:
+            name = server.tokens.get(args[1]) if cmd == "tlogin" and len(args) > 1 else None
+            if name is None:
+                self.send("denied")
+                return
+            self.name = name
+            server.pms[name.lower()].add(self)
+            self.send("OK")
+            for sender, mtime, body in server.offline.pop(name.lower(), ()):
+                self.send("msgoff", sender, sender, "unknown", mtime, "0", body)
+            return
+        if self.name is None:
+            return
+        account = server.account(self.name)
+        if cmd == "wl":
+            items = list()
+            for contact in sorted(account["contacts"]):
+                online = bool(server.pms.get(contact.lower()))
+                items.extend((contact, "%d" % time.time(), "on" if online else "off", "0"))
+            self.send("wl", *items)
+        elif cmd == "getblock":
+            self.send("block_list", *sorted(account["blocked"]))
+        elif cmd == "wladd":
+            account["contacts"].add(args[1])
+        elif cmd == "wldelete":
+            account["contacts"].discard(args[1])
+        elif cmd == "block":
+            account["blocked"].add(args[1])
+        elif cmd == "unblock":
+            account["blocked"].discard(args[1])
+            self.send("unblocked", args[1])
+        elif cmd == "track":
+            online = bool(server.pms.get(args[1].lower()))
+            self.send("track", args[1], "0" if online else "%d" % time.time(), "online" if online else "offline")
+        elif cmd == "msg":
+            server.deliver(self.name, args[1], ":".join(args[2:]))
+
+
+################################################################
+# Login page
+################################################################
+async def _login(server, reader, writer):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            key, _, value = line.partition(":")
+            if key.strip().lower() == "content-length":
+                length = int(value)
+        form = urllib.parse.parse_qs((await reader.readexactly(length)).decode()) if length else dict()
+        name = form.get("user_id", [""])[0]
+        password = form.get("password", [""])[0]
+        server.logins += 1
+        if server.loginDelay:
+            await asyncio.sleep(server.loginDelay)
+        headers = ["HTTP/1.0 200 OK", "Content-Length: 0"]
+        if name and server.checkLogin(name, password):
+            token = secrets.token_hex(16)
+            server.tokens[token] = name
+            headers.append("Set-Cookie: auth.chatango.com=%s; Max-Age=%d; Path=/" % (token, server.tokenLifetime))
+        writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ValueError, OSError):
+        pass
+    finally:
+        writer.close()
+
+
+################################################################
+# Traffic
+################################################################
+class Traffic:
+    """A running traffic pattern, see MockChatango.traffic."""
+
+    def __init__(self, server, room, rate, users, churn, duration, body):
+        self.server = server
+        self.room = room
+        self.rate = rate
+        self.users = users
+        self.churn = churn
+        self.duration = duration
+        self.body = body
+        self.sent = 0
+        self.joins = 0
+        self.leaves = 0
+        self.task = None
+        self.done = threading.Event()
+
+    async def run(self):
+        room = self.room
+        names = ["user%d" % n for n in range(self.users)]
+        for name in names:
+            room.join(name)
+        spare = itertools.count(self.users)
+        start = last = time.monotonic()
+        owed = churned = 0.0
+        try:
+            while self.duration is None or last - start < self.duration:
+                await asyncio.sleep(0.01)
+                now = time.monotonic()
+                owed += self.rate * (now - last)
+                churned += self.churn * (now - last)
+                last = now
+                while owed >= 1:
+                    owed -= 1
+                    room.post(random.choice(names) if names else "user", self.body)
+                    self.sent += 1
+                while churned >= 1 and names:
+                    churned -= 1
+                    room.leave(names.pop(random.randrange(len(names))))
+                    name = "user%d" % next(spare)
+                    room.join(name)
+                    names.append(name)
+                    self.leaves += 1
+                    self.joins += 1
+        finally:
+            self.done.set()
+
+    def stop(self):
+        """Stop the pattern, its virtual users stay."""
+        self.server.loop.call_soon_threadsafe(self.task.cancel)
+        self.done.wait()
+
+
+################################################################
+# MockChatango class
+################################################################
+# noinspection PyPep8Naming
+class MockChatango:
+    """
+    Tag server, PM server and login page on localhost, for tests and benchmarks.
+
+    Everything runs on an asyncio loop in a background thread. Point a
+    manager at it with configure, then script rooms and traffic:
+
+        with MockChatango() as mock:
+            mock.configure(Bot)
+            mock.traffic("room", rate=50, users=200, churn=5)
+            Bot.easy_start(["room"], "bot", "pass")
+    """
+
+    historyOnJoin = 20  # history messages sent before inited
+    tokenLifetime = 86400
+    loginDelay = 0  # seconds the login page takes to answer
+
+    ####
+    # Init
+    ####
+    def __init__(self, host="127.0.0.1", accounts=None):
+        """
+        @type host: str
+        @param host: address to listen on
+
+        @type accounts: dict
+        @param accounts: name -> password, None to accept any name and password
+        """
+        self.host = host
+        self.accounts = accounts
+        self.rooms = dict()
+        self.tokens = dict()  # token -> account name
+        self.pms = collections.defaultdict(set)  # lowercased name -> PM connections
+        self.offline = collections.defaultdict(list)  # lowercased name -> [(sender, time, body), ...]
+        self.pmAccounts = dict()  # lowercased name -> contacts and blocked
+        self.loop = None
+        self.thread = None
+        self.servers = list()
+        self.roomPort = None
+        self.pmPort = None
+        self.loginPort = None
+
+        # stats
+        self.framesIn = collections.Counter()
+        self.framesOut = collections.Counter()
+        self.logins = 0
+
+    def start(self):
+        """Start serving, returns once the ports are bound."""
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name="mock_chatango", daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        loop = self.loop
+
+        async def listen():
+            room = await loop.create_server(lambda: _RoomConnection(self), self.host, 0)
+            pm = await loop.create_server(lambda: _PMConnection(self), self.host, 0)
+            login = await asyncio.start_server(lambda r, w: _login(self, r, w), self.host, 0)
+            self.servers = [room, pm, login]
+            self.roomPort, self.pmPort, self.loginPort = (s.sockets[0].getsockname()[1] for s in self.servers)
+
+        loop.run_until_complete(listen())
+        ready.set()
+        loop.run_forever()
+        for server in self.servers:
+            server.close()
+        loop.close()
+
+    def stop(self):
+        """Stop serving and close every connection."""
+        if self.loop is None:
+            return
+
+        def shutdown():
+            for room in self.rooms.values():
+                for conn in list(room.conns):
+                    conn.transport.close()
+            for conns in self.pms.values():
+                for conn in list(conns):
+                    conn.transport.close()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(shutdown)
+        self.thread.join()
+        self.loop = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    ####
+    # Setup
+    ####
+    @property
+    def loginURL(self):
+        return "http://%s:%d/login" % (self.host, self.loginPort)
+
+    def configure(self, mgr):
+        """
+        Point a RoomManager class or instance at this server.
+
+        @type mgr: RoomManager
+        @param mgr: manager class or instance
+        """
+        mgr.roomServer = self.host
+        mgr.roomPort = self.roomPort
+        mgr.PMHost = self.host
+        mgr.PMPort = self.pmPort
+        mgr.loginURL = self.loginURL
+        return mgr
+
+    def call(self, func, *args, **kw):
+        """
+        Run func on the server loop and wait for its result, for scripting from other threads.
+
+        @type func: function
+        @param func: e.g. mock.room("x").post
+        """
+        async def run():
+            return func(*args, **kw)
+        return asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def traffic(self, room, rate=1.0, users=0, churn=0.0, duration=None, body="hello"):
+        """
+        Start a traffic pattern in a room.
+
+        @type room: str
+        @param room: room name
+        @type rate: float
+        @param rate: messages per second
+        @type users: int
+        @param users: virtual users present in the room, the messages come from them
+        @type churn: float
+        @param churn: virtual users replaced per second (one leave and one join each)
+        @type duration: float
+        @param duration: seconds to run for, None until stopped
+        @type body: str
+        @param body: message text
+
+        @rtype: Traffic
+        @return: handle with counters and stop
+        """
+        traffic = Traffic(self, None, rate, users, churn, duration, body)
+
+        async def start():
+            traffic.room = self.room(room)
+            traffic.task = self.loop.create_task(traffic.run())
+        asyncio.run_coroutine_threadsafe(start(), self.loop).result()
+        return traffic
+
+    ####
+    # State, used from the server loop
+    ####
+    def room(self, name):
+        """Get a room, creating it if needed."""
+        name = name.lower()
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = MockRoom(self, name)
+        return room
+
+    def checkLogin(self, name, password):
+        return self.accounts is None or self.accounts.get(name.lower(), self.accounts.get(name)) == password
+
+    def account(self, name):
+        return self.pmAccounts.setdefault(name.lower(), {"contacts": set(), "blocked": set()})
+
+    def deliver(self, sender, target, body):
+        mtime = "%.2f" % time.time()
+        conns = self.pms.get(target.lower())
+        if not conns:
+            self.offline[target.lower()].append((sender, mtime, body))
+            return
+        for conn in list(conns):
+            conn.send("msg", sender, sender, "unknown", mtime, "0", body)
+
+    def stats(self):
+        """
+        Get traffic statistics.
+
+        @rtype: dict
+        @return: frames received and sent by command, connections, logins
+        """
+        return {
+            "framesIn": dict(self.framesIn),
+            "framesOut": dict(self.framesOut),
+            "roomConnections": sum(len(room.conns) for room in self.rooms.values()),
+            "pmConnections": sum(len(conns) for conns in self.pms.values()),
+            "logins": self.logins,
+        }
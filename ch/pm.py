@@ -14,8 +14,10 @@
 ################################################################
 # Imports
 ################################################################
+import http.cookiejar
 import re
 import socket
+import threading
 import time
 import urllib.parse
 import urllib.request
@@ -26,7 +28,7 @@ import ch
 ################################################################
 # PM class
 ################################################################
-class PM:
+class PM(ch.common.Dispatcher):
     """Manages a connection with Chatango PM."""
     name = '#PM' 
 
@@ -35,34 +37,70 @@ class PM:
     ####
     def __init__(self, mgr):
         self._auth_re = re.compile(r"auth\.chatango\.com ?= ?([^;]*)", re.IGNORECASE)
+        self._expires_re = re.compile(r";\s*(?:max-age=(\d+)|expires=([^;]*))", re.IGNORECASE)
         self.connected = False
         self.mgr = mgr
         self._auid = None
+        self._authExpires = None
+        self._authCached = False
         self._blocklist = set()
         self._contacts = set()
         self._status = dict()
         self._wlock = False
+        self._wlockLock = threading.Lock()
         self._firstCommand = True
         self._wbuf = b""
-        self._wlockbuf = b""
-        self._rbuf = ""
+        self._wlockbuf = list()
+        self._rbuf = ch.common.Framer()
+        self._attempt = 0
         self.sock = None
         self.pingTask = None
         self._write = self._writeUnlocked
-        self.sendCommand = self._firstSendCommand
+        self.sendCommand = self._otherSendCommand
         self._connect()
 
     ####
     # Connections
     ####
     def _connect(self):
+        """Log in and connect in the background, commands get buffered until the server says OK."""
         self._wbuf = b""
-        self.sock = socket.socket()
-        self.sock.connect((self.mgr.PMHost, self.mgr.PMPort))
-        self.sendCommand = self._firstSendCommand
+        self._rbuf = ch.common.Framer()
+        self._setWriteLock(True)
+        self._attempt += 1
+        threading.Thread(target=self._connectWorker, args=(self._attempt,), name="pm_connect", daemon=True).start()
+
+    def _connectWorker(self, attempt):
+        # failures get reported on the manager's threads, handlers never run on this one
+        try:
+            self._open()
+        except OSError:
+            self.sock = None
+            self.mgr.setTimeout(0, self._loginFailed, attempt)
+            return
         if self.auth():
+            if attempt != self._attempt:  # disconnected meanwhile
+                self._close()
+                return
+            self.mgr.register(self)
             self.pingTask = self.mgr.setInterval(self.mgr.pingDelay, self.ping)
             self.connected = True
+        else:
+            self.mgr.setTimeout(0, self._loginFailed, attempt)
+
+    def _loginFailed(self, attempt):
+        """
+        Logging in failed, drop what got buffered for after the login and tell the bot.
+
+        @type attempt: int
+        @param attempt: the connect attempt that failed
+        """
+        if attempt != self._attempt:  # another attempt started meanwhile
+            return
+        with self._wlockLock:
+            self._wlockbuf = list()
+            self._write = self._writeDropped
+        self._callEvent("onLoginFail")
 
     def _getAuth(self, name, password):
         """
@@ -83,11 +121,12 @@ class PM:
             "checkerrors": "yes"
         }).encode()
         try:
-            resp = urllib.request.urlopen("http://chatango.com/login", data)
+            resp = urllib.request.urlopen(self.mgr.loginURL, data)
             headers = resp.headers
         except:
             return None
 
+        self._authExpires = None
         for header, value in headers.items():
             if header.lower() == "set-cookie":
                 m = self._auth_re.search(value)
@@ -95,28 +134,68 @@ class PM:
                     auth = m.group(1)
                     if auth == "":
                         return None
+                    for maxage, expires in self._expires_re.findall(value):
+                        if maxage:
+                            self._authExpires = time.time() + int(maxage)
+                            break
+                        self._authExpires = http.cookiejar.http2time(expires.strip())
                     return auth
         return None
 
+    def _getToken(self):
+        """
+        Get an auid, from the token cache if there is a valid one, logging in otherwise.
+
+        @rtype: str
+        @return: auid
+        """
+        cache = ch.auth.getCache(self.mgr.authCacheFile)
+        auid = cache.get(self.mgr.loginURL, self.mgr.name)
+        self._authCached = auid is not None
+        if auid is None:
+            auid = self._getAuth(self.mgr.name, self.mgr.password)
+            if auid is not None:
+                cache.put(self.mgr.loginURL, self.mgr.name, auid, self._authExpires)
+        return auid
+
     def auth(self):
-        self._auid = self._getAuth(self.mgr.name, self.mgr.password)
+        self._auid = self._getToken()
         if self._auid is None:
-            self.sock.close()
-            self._callEvent("onLoginFail")
-            self.sock = None
+            self._close()
             return False
-        self.sendCommand("tlogin", self._auid, "2")
-        self._setWriteLock(True)
+        self._login()
         return True
 
+    def _login(self):
+        # the first frame goes past the write lock and has no \r\n
+        self._writeUnlocked(":".join(("tlogin", self._auid, "2")).encode() + b"\x00")
+
     def disconnect(self):
         """Disconnect the bot from PM"""
         self._disconnect()
         self._callEvent("onPMDisconnect")
 
+    def _lost(self):
+        """The server closed the connection or it broke."""
+        self.disconnect()
+
     def _disconnect(self):
         self.connected = False
-        self.pingTask.cancel()
+        self._attempt += 1
+        if self.pingTask is not None:
+            self.pingTask.cancel()
+            self.pingTask = None
+        self._close()
+
+    def _open(self):
+        sock = socket.create_connection((self.mgr.PMHost, self.mgr.PMPort), self.mgr.connectTimeout)
+        sock.setblocking(False)
+        self.sock = sock
+
+    def _close(self):
+        if self.sock is None:
+            return
+        self.mgr.unregister(self)
         self.sock.close()
         self.sock = None
 
@@ -130,8 +209,7 @@ class PM:
         @type data: bytes
         @param data: data to be fed
         """
-        *foods, self._rbuf = (self._rbuf + data.decode('utf-8', errors="replace")).split("\x00")
-        for food in foods:
+        for food in self._rbuf.feed(data):
             food = food.rstrip("\r\n")
             if food:
                 self._process(food)
@@ -143,19 +221,15 @@ class PM:
         @type data: str
         @param data: the command string
         """
-        self._callEvent("onRaw", data)
-        data = data.split(":")
-        cmd, args = data[0], data[1:]
-        func = "_rcmd_" + cmd
-        if hasattr(self, func):
-            try:
-                getattr(self, func)(*args)
-            except:
-                print(args)
-                raise
-        else:
-            if ch.debug:
-                print("[unknown] data: " + str(data))
+        if "onRaw" in self.mgr.events:
+            self.mgr.callEvent(self, "onRaw", data)
+        try:
+            handled = self.dispatch(data)
+        except:
+            print(data)
+            raise
+        if not handled and ch.debug:
+            print("[unknown] data: " + str(data))
 
     ####
     # Properties
@@ -193,7 +267,7 @@ class PM:
             self._contacts.add(user)
         self._callEvent("onPMContactlistReceive")
 
-    def _rcmd_block_list(self, args):
+    def _rcmd_block_list(self, *args):
         self._blocklist = set()
         for name in args:
             if name == "":
@@ -227,17 +301,21 @@ class PM:
         self._status[user] = [last_on, is_on, idle]
 
     def _rcmd_denied(self):
+        ch.auth.getCache(self.mgr.authCacheFile).drop(self.mgr.loginURL, self.mgr.name)
         self._disconnect()
-        self._callEvent("onLoginFail")
+        if self._authCached:  # the cached token went stale, log in again
+            self._connect()
+        else:
+            self._loginFailed(self._attempt)
 
-    def _rcmd_msg(self, name, cid, unknown, mtime, pro, *rawmsgs):
+    def _rcmd_msg(self, name, cid, unknown, mtime, pro, rawmsg):
         user = ch.User(name)
-        body = ch.strip_html(":".join(rawmsgs))
+        body = ch.strip_html(rawmsg)
         self._callEvent("onPMMessage", user, body)
 
-    def _rcmd_msgoff(self, name, cid, unknown, mtime, pro, *rawmsgs):
+    def _rcmd_msgoff(self, name, cid, unknown, mtime, pro, rawmsg):
         user = ch.User(name)
-        body = ch.strip_html(":".join(rawmsgs))
+        body = ch.strip_html(rawmsg)
         self._callEvent("onPMOfflineMessage", user, body)
 
     def _rcmd_wlonline(self, name, ltime):
@@ -329,27 +407,33 @@ class PM:
     # Util
     ####
     def _callEvent(self, evt, *args, **kw):
-        getattr(self.mgr, evt)(self, *args, **kw)
-        self.mgr.onEventCalled(self, evt, *args, **kw)
+        if evt in self.mgr.events:
+            self.mgr.callEvent(self, evt, *args, **kw)
 
     def _writeLocked(self, data):
-        self._wlockbuf += data
+        with self._wlockLock:
+            if self._wlock:
+                self._wlockbuf.append(data)
+                return
+        self._writeUnlocked(data)
 
     def _writeUnlocked(self, data):
         self.mgr.write(self, data)
 
-    def _setWriteLock(self, lock):
-        self._wlock = lock
-        if self._wlock is False:
-            self._write = self._writeUnlocked
-            self._write(self._wlockbuf)
-            self._wlockbuf = b""
-        else:
-            self._write = self._writeLocked
+    def _writeDropped(self, data):
+        pass  # not logged in, nowhere to send it
 
-    def _firstSendCommand(self, *args):
-        self._write(":".join(args).encode() + b"\x00")
-        self.sendCommand = self._otherSendCommand
+    def _setWriteLock(self, lock):
+        with self._wlockLock:
+            self._wlock = lock
+            if lock is False:
+                self._write = self._writeUnlocked
+                buf, self._wlockbuf = self._wlockbuf, list()
+            else:
+                self._write = self._writeLocked
+                buf = ()
+        for data in buf:
+            self._writeUnlocked(data)
 
     def _otherSendCommand(self, *args):
         self._write(":".join(args).encode() + b"\r\n\x00")
@@ -0,0 +1,201 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import collections
+import threading
+import time
+
+
+################################################################
+# RateLimiter class
+################################################################
+# noinspection PyPep8Naming
+class RateLimiter:
+    """
+    Token bucket pacing the messages of a room.
+
+    The rate gets halved on a flood warning, quartered on a flood ban
+    (which also holds everything back for the ban duration) and grows
+    back linearly while the room stays quiet, so it settles just under
+    what the server tolerates.
+    """
+
+    ####
+    # Init
+    ####
+    def __init__(self, mgr, send, rate=2.0, burst=5, minRate=0.2, recovery=0.05):
+        """
+        @type mgr: RoomManager
+        @param mgr: manager used for scheduling
+
+        @type send: function
+        @param send: called with the queued arguments once allowed through
+
+        @type rate: float
+        @param rate: initial and maximum messages per second
+
+        @type burst: int
+        @param burst: bucket size
+
+        @type minRate: float
+        @param minRate: the rate never goes lower than this, must be positive
+
+        @type recovery: float
+        @param recovery: messages per second regained every second
+        """
+        if rate <= 0 or minRate <= 0:
+            raise ValueError("rate and minRate must be positive, got %r and %r" % (rate, minRate))
+        self.mgr = mgr
+        self.send = send
+        self.maxRate = rate
+        self.rate = rate
+        self.burst = burst
+        self.minRate = minRate
+        self.recovery = recovery
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.pausedUntil = 0
+        self.queue = collections.deque()
+        self.task = None
+        self.lock = threading.RLock()
+
+        # stats
+        self.sent = 0
+        self.delayed = 0
+        self.drained = 0  # delayed ones sent so far
+        self.dropped = 0
+        self.totalDelay = 0.0
+        self.maxDelay = 0.0
+        self.warnings = 0
+        self.bans = 0
+
+    ####
+    # Util
+    ####
+    def _refill(self, now):
+        # time spent paused by a ban earns nothing, or the bucket would burst out as the ban ends
+        elapsed = now - max(self.stamp, self.pausedUntil)
+        self.stamp = now
+        if now < self.pausedUntil:
+            return
+        self.rate = min(self.maxRate, self.rate + self.recovery * elapsed)
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    def _schedule(self, now):
+        if self.task is not None or not self.queue:
+            return
+        wait = max(self.pausedUntil - now, (1 - self.tokens) / self.rate, 0)
+        self.task = self.mgr.setTimeout(wait, self._drain)
+
+    def _drain(self):
+        with self.lock:
+            self.task = None
+            now = time.monotonic()
+            self._refill(now)
+            while self.queue and self.tokens >= 1 and now >= self.pausedUntil:
+                stamp, args = self.queue.popleft()
+                delay = now - stamp
+                self.totalDelay += delay
+                self.maxDelay = max(self.maxDelay, delay)
+                self.tokens -= 1
+                self.sent += 1
+                self.drained += 1
+                self.send(*args)
+            self._schedule(now)
+
+    ####
+    # Sending
+    ####
+    def submit(self, *args):
+        """
+        Send now if the bucket allows it, queue otherwise.
+
+        @param args: arguments for send
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if not self.queue and self.tokens >= 1 and now >= self.pausedUntil:
+                self.tokens -= 1
+                self.sent += 1
+                self.send(*args)
+                return
+            self.queue.append((now, args))
+            self.delayed += 1
+            self._schedule(now)
+
+    def clear(self):
+        """Drop everything queued."""
+        with self.lock:
+            self.dropped += len(self.queue)
+            self.queue.clear()
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+
+    ####
+    # Flood signals
+    ####
+    def warn(self):
+        """Called on a flood warning, halves the rate."""
+        with self.lock:
+            # credit what was earned at the old rate first
+            self._refill(time.monotonic())
+            self.warnings += 1
+            self.rate = max(self.minRate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+    def ban(self, seconds):
+        """
+        Called on a flood ban, quarters the rate and holds back for the ban duration.
+
+        @type seconds: int
+        @param seconds: ban duration
+        """
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.bans += 1
+            self.rate = max(self.minRate, self.rate / 4)
+            self.tokens = 0
+            self.pausedUntil = max(self.pausedUntil, now + seconds)
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+            self._schedule(now)
+
+    ####
+    # Stats
+    ####
+    def stats(self):
+        """
+        Get pacing statistics.
+
+        @rtype: dict
+        @return: current rate, queued, sent, delayed and dropped counts, delays in seconds of the delayed ones sent
+        """
+        with self.lock:
+            return {
+                "rate": self.rate,
+                "queued": len(self.queue),
+                "sent": self.sent,
+                "delayed": self.delayed,
+                "dropped": self.dropped,
+                "avgDelay": self.totalDelay / self.drained if self.drained else 0.0,
+                "maxDelay": self.maxDelay,
+                "warnings": self.warnings,
+                "bans": self.bans,
+            }
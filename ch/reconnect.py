@@ -0,0 +1,284 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import collections
+import heapq
+import itertools
+import random
+import socket
+import threading
+import time
+
+
+################################################################
+# Reconnector class
+################################################################
+# noinspection PyPep8Naming
+class Reconnector:
+    """
+    Spreads out the reconnects of rooms.
+
+    Every room waits an exponentially growing, jittered delay before its
+    next attempt. Only a few attempts run at once per tag server, and rooms
+    that are due at the same time go in priority order, so a server blip
+    doesn't turn into hundreds of rooms hammering it in the same instant.
+    An attempt ends once the room is inited again, or fails when the
+    connection fails or isn't inited in time.
+    """
+
+    ####
+    # Init
+    ####
+    def __init__(self, mgr, delay=1.0, maxDelay=300.0, jitter=0.5, perServer=4, timeout=30, attempts=None):
+        """
+        @type mgr: RoomManager
+        @param mgr: manager used for scheduling
+
+        @type delay: float
+        @param delay: seconds before the first attempt, doubled on every failure
+
+        @type maxDelay: float
+        @param maxDelay: the delay never goes higher than this
+
+        @type jitter: float
+        @param jitter: fraction of the delay taken off at random
+
+        @type perServer: int
+        @param perServer: attempts running at once per tag server
+
+        @type timeout: float
+        @param timeout: seconds an attempt may take to get inited
+
+        @type attempts: int
+        @param attempts: give up after this many failed attempts, None to never give up
+        """
+        self.mgr = mgr
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.perServer = perServer
+        self.timeout = timeout
+        self.attempts = attempts
+        self.lock = threading.RLock()
+        self.seq = itertools.count()
+        self.rooms = dict()  # room -> [failed attempts, down since], until recovered
+        self.waiting = list()  # heap of (due, seq, room), stale entries are skipped
+        self.queued = dict()  # room -> seq of its live waiting entry
+        self.ready = list()  # (-priority, due, seq, room) due but waiting for a free slot
+        self.active = dict()  # room -> (server, timeout task)
+        self.servers = collections.Counter()  # server -> attempts running
+        self.task = None
+
+        # stats
+        self.started = 0
+        self.recovered = 0
+        self.failed = 0
+        self.givenUp = 0
+        self.totalRecover = 0.0
+        self.maxRecover = 0.0
+        self.recoverTimes = dict()  # room name -> seconds its last recovery took
+
+    ####
+    # Util
+    ####
+    def _backoff(self, attempts):
+        delay = min(self.maxDelay, self.delay * 2 ** attempts)
+        return delay * (1 - self.jitter * random.random())
+
+    def _queue(self, room, delay):
+        seq = next(self.seq)
+        self.queued[room] = seq
+        heapq.heappush(self.waiting, (time.monotonic() + delay, seq, room))
+
+    def _release(self, room):
+        server, task = self.active.pop(room)
+        task.cancel()
+        self.servers[server] -= 1
+        if not self.servers[server]:
+            del self.servers[server]
+
+    def _schedule(self):
+        # attempts start on the scheduler, never on the thread that released a slot
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        while self.waiting and self.queued.get(self.waiting[0][2]) != self.waiting[0][1]:
+            heapq.heappop(self.waiting)
+        if self.ready and len(self.ready) > self._blocked():
+            self.task = self.mgr.setTimeout(0, self._run)
+        elif self.waiting:
+            self.task = self.mgr.setTimeout(max(0, self.waiting[0][0] - time.monotonic()), self._run)
+
+    def _blocked(self):
+        return sum(1 for item in self.ready if self.servers[item[3].server] >= self.perServer)
+
+    def _run(self):
+        with self.lock:
+            self.task = None
+            now = time.monotonic()
+            while self.waiting and self.waiting[0][0] <= now:
+                due, seq, room = heapq.heappop(self.waiting)
+                if self.queued.get(room) == seq:
+                    del self.queued[room]
+                    self.ready.append((-getattr(room, "priority", 0), due, seq, room))
+            self.ready.sort(key=lambda item: item[:3])
+            start, ready = list(), list()
+            for item in self.ready:
+                room = item[3]
+                if self.servers[room.server] < self.perServer:
+                    self.servers[room.server] += 1
+                    self.active[room] = (room.server, self.mgr.setTimeout(self.timeout, self._expire, room))
+                    self.started += 1
+                    start.append(room)
+                else:
+                    ready.append(item)
+            self.ready = ready
+            self._schedule()
+        for room in start:
+            room._reconnect()
+
+    def _expire(self, room):
+        with self.lock:
+            if room not in self.active:
+                return
+        room._connectFail(socket.timeout("reconnect attempt timed out"))
+
+    ####
+    # Reconnecting
+    ####
+    def schedule(self, room):
+        """
+        Reconnect a room after its backoff delay, nothing happens if it already is on its way.
+
+        @type room: Room
+        @param room: room to reconnect
+        """
+        with self.lock:
+            if room in self.queued or room in self.active:
+                return
+            state = self.rooms.setdefault(room, [0, time.monotonic()])
+            self._queue(room, self._backoff(state[0]))
+            self._schedule()
+
+    def done(self, room):
+        """
+        Called when a room got inited, ends its attempt and records how long it took to recover.
+
+        @type room: Room
+        @param room: room
+        """
+        with self.lock:
+            state = self.rooms.pop(room, None)
+            if state is None:
+                return
+            self.queued.pop(room, None)
+            self.ready = [item for item in self.ready if item[3] is not room]
+            if room in self.active:
+                self._release(room)
+            took = time.monotonic() - state[1]
+            self.recovered += 1
+            self.totalRecover += took
+            self.maxRecover = max(self.maxRecover, took)
+            self.recoverTimes[room.name] = took
+            self._schedule()
+
+    def retry(self, room):
+        """
+        Called when a room's connection failed, schedules the next attempt if the room is being reconnected.
+
+        @type room: Room
+        @param room: room
+
+        @rtype: bool
+        @return: whether another attempt got scheduled
+        """
+        with self.lock:
+            if room not in self.active:
+                return False
+            self._release(room)
+            self.failed += 1
+            state = self.rooms[room]
+            state[0] += 1
+            if self.attempts is not None and state[0] >= self.attempts:
+                del self.rooms[room]
+                self.givenUp += 1
+                retry = False
+            else:
+                self._queue(room, self._backoff(state[0]))
+                retry = True
+            self._schedule()
+        return retry
+
+    def cancel(self, room):
+        """
+        Stop reconnecting a room for now, its backoff is kept for the next schedule.
+
+        @type room: Room
+        @param room: room
+        """
+        with self.lock:
+            self.queued.pop(room, None)
+            self.ready = [item for item in self.ready if item[3] is not room]
+            if room in self.active:
+                self._release(room)
+            self._schedule()
+
+    def forget(self, room):
+        """
+        Stop reconnecting a room and drop its backoff.
+
+        @type room: Room
+        @param room: room
+        """
+        with self.lock:
+            self.cancel(room)
+            self.rooms.pop(room, None)
+
+    def clear(self):
+        """Stop every reconnect."""
+        with self.lock:
+            for room in list(self.active):
+                self._release(room)
+            self.rooms.clear()
+            self.waiting = list()
+            self.queued.clear()
+            self.ready = list()
+            if self.task is not None:
+                self.task.cancel()
+                self.task = None
+
+    ####
+    # Stats
+    ####
+    def stats(self):
+        """
+        Get reconnect statistics.
+
+        @rtype: dict
+        @return: waiting and running attempts, outcomes, times to recover in seconds
+        """
+        with self.lock:
+            return {
+                "waiting": len(self.queued) + len(self.ready),
+                "active": len(self.active),
+                "started": self.started,
+                "recovered": self.recovered,
+                "failed": self.failed,
+                "givenUp": self.givenUp,
+                "avgRecover": self.totalRecover / self.recovered if self.recovered else 0.0,
+                "maxRecover": self.maxRecover,
+                "rooms": dict(self.recoverTimes),
+            }
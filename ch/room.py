@@ -14,7 +14,6 @@
 ################################################################
 # Imports
 ################################################################
-import socket
 import time
 import html
 
@@ -25,7 +24,7 @@ import ch
 # Room class
 ################################################################
 # noinspection PyPep8Naming
-class Room:
+class Room(ch.common.Dispatcher):
     """Manages a connection with a Chatango room."""
 
     ####
@@ -35,9 +34,10 @@ class Room:
         """init, don't overwrite"""
         # Basic stuff
         self.name = room
-        self.server = server or ch.getServer(room)
-        self.port = port or 443
+        self.server = server or mgr.roomServer or ch.getServer(room)
+        self.port = port or mgr.roomPort
         self.mgr = mgr
+        self.priority = 0  # rooms with a higher priority reconnect first
 
         # Under the hood
         self.user = self.mgr.user
@@ -46,14 +46,14 @@ class Room:
         self.uid = uid or ch.genUid()
         self.n = "000"
         self.logged = False
-        self.rbuf = ""
+        self.rbuf = ch.common.Framer()
         self.wbuf = b""
-        self.wlockbuf = b""
+        self.wlockbuf = list()
         self.owner = None
         self.mods = dict()
         self.mqueue = dict()
-        self.history = list()
-        self.userlist = list()
+        self.history = ch.history.History(self.mgr.maxHistoryLength)
+        self.userlist = ch.userlist.UserList()
         self.connectAmmount = 0
         self.premium = False
         self.userCount = 0
@@ -75,6 +75,12 @@ class Room:
         self.participant_lock = True
         self.participant_queue = list()
         self.process = self._process
+        if self.mgr and self.mgr.floodRate:
+            self.limiter = ch.ratelimit.RateLimiter(
+                self.mgr, lambda *args: self.sendCommand(*args), rate=self.mgr.floodRate, burst=self.mgr.floodBurst,
+                minRate=self.mgr.floodMinRate, recovery=self.mgr.floodRecovery)
+        else:
+            self.limiter = None
 
         # Inited vars
         if self.mgr:
@@ -120,10 +126,12 @@ class Room:
         self.i_log = list()
 
     def _rcmd_denied(self):
+        self.mgr.reconnector.forget(self)
         self._disconnect()
         self._callEvent("onConnectFail")
 
     def _rcmd_inited(self):
+        self.mgr.reconnector.done(self)
         self.sendCommand("g_participants")
         self.sendCommand("getpremium", "1")
         self.requestBanlist()
@@ -164,48 +172,9 @@ class Room:
             self._callEvent("onModRemove", user)
         self._callEvent("onModChange")
 
-    def _rcmd_b(self, mtime, name, anon_name, puid, mid, i, ip, channel, _, *rawmsgs):
-        mtime = float(mtime)
-        rawmsg = ":".join(rawmsgs)
-        msg, n, f = ch.clean_message(rawmsg)
-        if name == "":
-            nameColor = None
-            name = "#" + (anon_name or "!anon" + ch.getAnonId(n, puid))
-        else:
-            nameColor = ch.parseNameColor(n)
-
-        if f:
-            fontColor, fontFace, fontSize = ch.parseFont(f)
-        else:
-            fontColor, fontFace, fontSize = None, None, None
-
-        user = ch.User(
-            name=name,
-            puid=puid,
-            ip=ip,
-            nameColor=nameColor,
-            fontColor=fontColor,
-            fontFace=fontFace,
-            fontSize=fontSize,
-        )
+    def _rcmd_b(self, mtime, name, anon_name, puid, unid, i, ip, channel, _, rawmsg):
         # Create an anonymous message and queue it because mid is unknown.
-        msg = ch.Message(
-            time=mtime,
-            user=user,
-            body=msg,
-            raw=rawmsg,
-            ip=ip,
-            i=i,
-            channel=channel,
-            nameColor=nameColor,
-            fontColor=fontColor,
-            fontFace=fontFace,
-            fontSize=fontSize,
-            mid=mid,
-            puid=puid,
-            room=self
-        )
-        self.mqueue[i] = msg
+        self.mqueue[i] = self._makeMessage(mtime, name, anon_name, puid, unid, ip, channel, rawmsg, i=i)
 
     def _rcmd_u(self, i, mid):
         msg = self.mqueue.get(i, None)
@@ -215,50 +184,39 @@ class Room:
             self._addHistory(msg)
             self._callEvent("onMessage", msg.user, msg)
 
-    def _rcmd_i(self, mtime, name, anon_name, puid, mid, i, ip, channel, _, *rawmsgs):
-        mtime = float(mtime)
-        rawmsg = ":".join(rawmsgs)
-        msg, n, f = ch.clean_message(rawmsg)
-        if name == "":
-            nameColor = "000"
-            name = "#" + (anon_name or "!anon" + ch.getAnonId(n, puid))
-        else:
-            nameColor = ch.parseNameColor(n)
-        # Create an anonymous message and queue it because mid is unknown.
-        if f:
-            fontColor, fontFace, fontSize = ch.parseFont(f)
-        else:
-            fontColor, fontFace, fontSize = None, None, None
-        user = ch.User(
-            name=name,
-            puid=puid,
-            ip=ip,
-            nameColor=nameColor,
-            fontColor=fontColor,
-            fontFace=fontFace,
-            fontSize=fontSize,
-        )
+    def _rcmd_i(self, mtime, name, anon_name, puid, unid, mid, ip, channel, _, rawmsg):
+        msg = self._makeMessage(mtime, name, anon_name, puid, unid, ip, channel, rawmsg)
+        msg.attach(mid)
+        self.i_log.append(msg)
+
+    def _makeMessage(self, mtime, name, anon_name, puid, unid, ip, channel, rawmsg, i=None):
+        """Build a Message, its body and font only get parsed once something reads them."""
         msg = ch.Message(
-            time=mtime,
-            user=user,
-            body=msg,
+            time=float(mtime),
             raw=rawmsg,
             ip=ip,
             i=i,
+            unid=unid,
             channel=channel,
-            nameColor=nameColor,
-            fontColor=fontColor,
-            fontFace=fontFace,
-            fontSize=fontSize,
-            mid=mid,
             puid=puid,
+            anon=name == "",
             room=self
         )
-        self.i_log.append(msg)
+        if name == "":
+            name = "#" + (anon_name or "!anon" + ch.getAnonId(msg.n, puid))
+        msg.user = ch.User(
+            name=name,
+            puid=puid,
+            ip=ip,
+            style=msg
+        )
+        return msg
 
     @ch.common.resplit(";")
     def _rcmd_g_participants(self, *items):
         for item in items:
+            if not item:  # empty room
+                continue
             sid, ctime, puid, name, anon_name, unknown = item.split(":")
             if name == "None":
                 n = ctime.rsplit('.', 1)[0][-4:]
@@ -273,7 +231,7 @@ class Room:
         self.participant_lock = False
         for participant in self.participant_queue:
             self._rcmd_participant(*participant)
-        self._participant_queue = list()
+        self.participant_queue = list()
 
     def _rcmd_participant(self, status, sid, puid, name, anon_name, unknown, ctime):
         if self.participant_lock:
@@ -290,33 +248,39 @@ class Room:
         )
 
         if status == "0":  # leave
-            self.userlist.remove(user)
+            self.userlist.discard(user)
             if not self.mgr.userlistEventUnique or user not in self.userlist:
                 self._callEvent("onLeave", user, puid)
         else:  # join
             self.userlist.append(user)
-            if not self.mgr.userlistEventUnique or user not in self.userlist:
+            if not self.mgr.userlistEventUnique or self.userlist.count(user) == 1:
                 self._callEvent("onJoin", user, puid)
 
     def _rcmd_show_fw(self):
+        if self.limiter:
+            self.limiter.warn()
         self._callEvent("onFloodWarning")
 
     def _rcmd_show_tb(self, seconds):
+        if self.limiter:
+            self.limiter.ban(int(seconds))
         self._callEvent("onFloodBan", int(seconds))
 
     def _rcmd_tb(self, seconds):
+        if self.limiter:
+            self.limiter.ban(int(seconds))
         self._callEvent("onFloodBanRepeat", int(seconds))
 
     def _rcmd_delete(self, mid):
-        msg = self.msgs.get(mid)
-        if msg and msg in self.history:
+        msg = self.history.get(mid)
+        if msg:
             self.history.remove(msg)
             self._callEvent("onMessageDelete", msg.user, msg)
             msg.detach()
 
-    def _rcmd_deleteall(self, args):
-        for mid in args:
-            self.delete(mid)
+    def _rcmd_deleteall(self, *mids):
+        for mid in mids:
+            self._rcmd_delete(mid)
 
     def _rcmd_n(self, count):
         self.userCount = int(count, 16)
@@ -403,22 +367,44 @@ class Room:
     ####
     def _connect(self):
         """Connect to the server."""
-        self.sock = socket.socket()
-        self.sock.connect((self.server, self.port))
+        self._open()
         self.sendCommand = self._firstSendCommand
         self.write = self._writeUnlocked
         self.participant_lock = True
         self.participant_queue = list()
         self.process = self._process
+        self.rbuf = ch.common.Framer()
         self.wbuf = b""
         self._auth()
         self.pingTask = self.mgr.setInterval(self.mgr.pingDelay, self.ping)
-        if not self.reconnecting:
-            self.connected = True
+        self.connected = True
+        self.mgr.rooms[self.name] = self
+        self.mgr.register(self)
+
+    def _connectFail(self, error):
+        """
+        The connection couldn't be established.
+
+        @type error: OSError
+        @param error: why
+        """
+        if self.mgr.reconnector.retry(self):
+            self._suspend()
+            return
+        self.connected = False
+        self.pingTask.cancel()
+        if self.limiter:
+            self.limiter.clear()
+        self._close()
+        self.process = lambda x: x
+        if self.mgr.rooms.get(self.name) is self:
+            del self.mgr.rooms[self.name]
+        self._callEvent("onConnectFail")
 
     def reconnect(self):
-        """Reconnect."""
-        self._reconnect()
+        """Reconnect after a backoff delay, see RoomManager.reconnectDelay."""
+        self.mgr.rooms.setdefault(self.name, self)
+        self.mgr.reconnector.schedule(self)
 
     def _reconnect(self):
         """Reconnect."""
@@ -430,24 +416,51 @@ class Room:
         self.reconnecting = False
 
     def disconnect(self):
-        """Disconnect."""
+        """Disconnect, stopping any reconnect of the room."""
+        self.mgr.reconnector.forget(self)
+        self._disconnect()
+        self._callEvent("onDisconnect")
+
+    def _lost(self):
+        """The server closed the connection or it broke."""
+        if self.mgr.reconnector.retry(self):  # lost during a reconnect attempt
+            self._suspend()
+            return
+        self.mgr.reconnector.cancel(self)
         self._disconnect()
         self._callEvent("onDisconnect")
 
+    def _suspend(self):
+        """Drop the connection but keep the room, for another attempt."""
+        reconnecting, self.reconnecting = self.reconnecting, True
+        self._disconnect()
+        self.reconnecting = reconnecting
+
     def _disconnect(self):
         """Disconnect from the server."""
         if not self.reconnecting:
             self.connected = False
-        for user in self.userlist:
-            if self in user.sids:
-                del user.sids[self]
-        self.userlist = list()
+        for user in self.userlist.unique():
+            with ch.user.registry.lock(user.name):
+                user.sids.pop(self, None)
+        self.userlist.clear()
         self.pingTask.cancel()
-        self.sock.close()
+        if self.limiter and not self.reconnecting:
+            self.limiter.clear()
+        self._close()
         self.process = lambda x: x
         if not self.reconnecting:
             del self.mgr.rooms[self.name]
 
+    def _open(self):
+        """Start connecting the socket, the manager finishes it."""
+        self.sock = self.mgr.connect(self, (self.server, self.port))
+
+    def _close(self):
+        """Take the socket away from the manager and close it."""
+        self.mgr.unregister(self)
+        self.sock.close()
+
     def _auth(self):
         """Authenticate."""
         # login as name with password
@@ -479,14 +492,14 @@ class Room:
     @property
     def userList(self):
         if self.mgr.userlistMode == ch.common.Userlist.Recent:
-            ul = (x.user for x in self.history[-self.mgr.userlistMemory:])
-        else:
-            ul = self.userlist
-
-        if self.mgr.userlistUnique:
-            return list(set(ul))
-        else:
+            ul = [x.user for x in self.history.recent(self.mgr.userlistMemory)]
+            if self.mgr.userlistUnique:
+                return list(set(ul))
             return ul
+        elif self.mgr.userlistUnique:
+            return self.userlist.unique()
+        else:
+            return list(self.userlist)
 
     @property
     def usernames(self):
@@ -504,6 +517,11 @@ class Room:
     def banList(self):
         return list(self.banlist.keys())
 
+    @property
+    def floodStats(self):
+        """Pacing statistics of outgoing messages, see RateLimiter.stats."""
+        return self.limiter.stats() if self.limiter else None
+
     @property
     def unBanList(self):
         return [[record["target"], record["src"]] for record in self.unbanlist.values()]
@@ -518,8 +536,7 @@ class Room:
         @type data: bytes
         @param data: data to be fed
         """
-        *foods, self.rbuf = (self.rbuf + data.decode('utf-8', errors="replace")).split("\x00")
-        for food in foods:
+        for food in self.rbuf.feed(data):
             food = food.rstrip("\r\n")
             if food:
                 self.process(food)
@@ -531,14 +548,10 @@ class Room:
         @type data: str
         @param data: the command string
         """
-        self._callEvent("onRaw", data)
-        cmd, *args = data.split(":")
-        func = "_rcmd_"+cmd
-        if hasattr(self, func):
-            getattr(self, func)(*args)
-        else:
-            if __debug__:
-                print("[unknown] data: " + str(data))
+        if "onRaw" in self.mgr.events:
+            self.mgr.callEvent(self, "onRaw", data)
+        if not self.dispatch(data) and __debug__:
+            print("[unknown] data: " + str(data))
 
     ####
     # Commands
@@ -571,7 +584,11 @@ class Room:
         @type channel: str
         @param channel: channel mode
         """
-        if not self.silent:
+        if self.silent:
+            return
+        if self.limiter:
+            self.limiter.submit("bm:tl2r", channel, msg)
+        else:
             self.sendCommand("bm:tl2r", channel, msg)
 
     def formatMessage(self, msg):
@@ -810,10 +827,11 @@ class Room:
         return self.banlist.get(user)
 
     def _callEvent(self, evt, *args, **kw):
-        self.mgr.callEvent(self, evt, *args, **kw)
+        if evt in self.mgr.events:
+            self.mgr.callEvent(self, evt, *args, **kw)
 
     def _writeLocked(self, data):
-        self.wlockbuf += data
+        self.wlockbuf.append(data)
 
     def _writeUnlocked(self, data):
         self.mgr.write(self, data)
@@ -822,8 +840,9 @@ class Room:
         self.wlock = lock
         if self.wlock is False:
             self.write = self._writeUnlocked
-            self.write(self.wlockbuf)
-            self.wlockbuf = b""
+            for data in self.wlockbuf:
+                self.write(data)
+            self.wlockbuf = list()
         else:
             self.write = self._writeLocked
 
@@ -859,19 +878,14 @@ class Room:
 
     def getLastMessage(self, user=None):
         """get last message said by user in a room"""
-        for msg in self.history[::-1]:
-            if not user or msg.user == user:
-                return msg
+        return self.history.last(user)
 
     def findUser(self, name):
         """check if user is in the room
 
         return User(name) if name in room else None
         """
-        name = name.lower()
-        for user in self.userlist:
-            if user.name == name:
-                return user
+        return self.userlist.find(name)
 
     ####
     # History
@@ -883,11 +897,8 @@ class Room:
         @type msg: Message
         @param msg: message
         """
-        self.history.append(msg)
-        if len(self.history) > self.mgr.maxHistoryLength:
-            rest, self.history = self.history[:-self.mgr.maxHistoryLength], self.history[-self.mgr.maxHistoryLength:]
-            for msg in rest:
-                msg.detach()
+        for old in self.history.append(msg):
+            old.detach()
 
     def __repr__(self):
         return "<Room: %s>" % self.name
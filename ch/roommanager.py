@@ -14,14 +14,21 @@
 ################################################################
 # Imports
 ################################################################
+import errno
+import heapq
+import itertools
+import os
 import queue
-import select
+import selectors
 import socket
 import threading
 import time
 
 import ch
 
+# writev limit, linux and most BSDs use 1024
+IOV_MAX = 1024
+
 
 # noinspection PyMethodMayBeStatic
 class BotCallback:
@@ -483,8 +490,12 @@ class RoomManager(BotCallback):
     PM = ch.PM
     PMHost = "c1.chatango.com"
     PMPort = 5222
-    TimerResolution = 0.2  # at least x second per tick
+    roomServer = None  # tag server every room connects to, picked by room name if None
+    roomPort = 443
+    loginURL = "http://chatango.com/login"
+    authCacheFile = None  # file to keep the PM auth token in across restarts, None for memory only
     pingDelay = 20
+    recvSize = 65536
     userlistMode = ch.common.Userlist.Recent
     userlistUnique = True
     userlistMemory = 50
@@ -492,23 +503,44 @@ class RoomManager(BotCallback):
     tooBigMessage = ch.common.BigMessage.Multiple
     maxLength = 700
     maxHistoryLength = 150
+    floodRate = 2.0  # messages per second per room, None to disable pacing
+    floodBurst = 5
+    floodMinRate = 0.2  # the rate never drops below this, must be positive
+    floodRecovery = 0.05  # messages per second regained every second
+    weightsFile = None  # tag server weights, ch.weightsFile if None
+    connectTimeout = 10  # seconds for a room connection to be established
+    connectConcurrency = 64  # rooms connecting at once while joining
+    reconnectDelay = 1.0  # seconds before the first reconnect attempt, doubled on every failure
+    reconnectMaxDelay = 300.0
+    reconnectJitter = 0.5  # fraction of the delay taken off at random
+    reconnectConcurrency = 4  # reconnect attempts at once per tag server
+    reconnectTimeout = 30  # seconds a reconnect attempt may take to get inited
+    reconnectAttempts = None  # give up after this many failed attempts, None to never give up
 
     ####
     # Init
     ####
     def __init__(self, name=None, password=None, pm=True):
-        self.name = name
-        self.password = password
-        self.running = False
-        self.tasks = set()
-        self.rooms = dict()
+        self._setup(name, password)
+        self.tasks = list()  # heap of (target, seq, task)
+        self.tasks_cond = threading.Condition()
+        self.tasks_seq = itertools.count()
+        self.tasks_cancelled = 0
         self.rooms_queue = queue.Queue()
-        self.sock_write_queue = queue.Queue()
+        self.write_queue = list()
+        self.write_lock = threading.Lock()
+        self.write_notified = False
+        self.outbufs = dict()
+        self.writable = set()
+        self.io_lock = threading.RLock()  # outbufs, writable and the selector, unregister runs on any thread
+        self.connecting = dict()  # con -> (deadline, error), watched for the connect to finish
+        self.connect_errors = dict()  # con -> error, connect started but not registered yet
+        self.connect_cond = threading.Condition()
         self.tick_thread = None
-        self.send_thread = None
-        self.recv_thread = None
+        self.io_thread = None
         self.join_thread = None
-        self.dummy_con = ch.common.DummyConnection()
+        self.selector = selectors.DefaultSelector()
+        self.dummy_con = ch.common.DummyConnection(mgr=self)
         if pm:
             if self.password:
                 self.pm = self.PM(mgr=self)
@@ -517,16 +549,154 @@ class RoomManager(BotCallback):
         else:
             self.pm = None
 
+    def _setup(self, name, password):
+        """State every manager has, whatever drives its connections."""
+        self.name = name
+        self.password = password
+        # held here, the registry forgets users nothing references and would drop our own styling
+        self._user = ch.User(name)
+        self.running = False
+        self.rooms = dict()
+        self.events = frozenset()
+        self.updateEvents()
+        self.reconnector = self._makeReconnector()
+        if self.weightsFile:
+            ch.loadWeights(self.weightsFile)
+
     ####
     # Util
     ####
-    def write(self, room, data):
-        self.sock_write_queue.put((room.sock, data))
+    def write(self, con, data):
+        """
+        Queue data to be sent on a connection, never blocks.
+
+        @type con: Room or PM
+        @param con: connection to write to
+        @type data: bytes
+        @param data: a frame
+        """
+        if self.io_thread is threading.current_thread():
+            # handlers run on the io thread, their writes get flushed before the next select
+            with self.write_lock:
+                self.write_queue.append((con, data))
+            return
+        with self.write_lock:
+            self.write_queue.append((con, data))
+            notify = not self.write_notified
+            self.write_notified = True
+        if notify:
+            self.dummy_con.notify()
+
+    def connect(self, con, address):
+        """
+        Start connecting a socket without blocking, register picks it up from there.
+
+        Once connected the queued frames get sent, if connecting fails or
+        takes longer than connectTimeout con._connectFail is called.
+
+        @type con: Room
+        @param con: connection the socket is for
+        @type address: tuple
+        @param address: (host, port)
+
+        @rtype: socket.socket
+        @return: the connecting socket
+        """
+        sock = socket.socket()
+        sock.setblocking(False)
+        error = None
+        try:
+            err = sock.connect_ex(address)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                error = OSError(err, os.strerror(err))
+        except OSError as e:  # couldn't resolve
+            error = e
+        with self.connect_cond:
+            self.connect_errors[con] = error
+        return sock
+
+    def register(self, con):
+        """
+        Register a connection with the reactor, called once per socket.
+
+        @type con: Room, PM or DummyConnection
+        @param con: connection whose sock should be watched for reading
+        """
+        with self.connect_cond:
+            pending = con in self.connect_errors
+            if pending:
+                error = self.connect_errors.pop(con)
+                self.connecting[con] = (0 if error else time.monotonic() + self.connectTimeout, error)
+        with self.io_lock:
+            if pending:
+                self.selector.register(con.sock, selectors.EVENT_WRITE, con)
+            elif con in self.outbufs:
+                self.selector.register(con.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, con)
+                self.writable.add(con)
+            else:
+                self.selector.register(con.sock, selectors.EVENT_READ, con)
+        if pending and self.io_thread is not threading.current_thread():
+            self.dummy_con.notify()  # the deadline may be earlier than what select waits for
+
+    def unregister(self, con):
+        """
+        Unregister a connection from the reactor, must be called before closing the socket.
+
+        Safe on any thread: the io thread never sends a frame queued
+        before this on the connection's next socket.
+
+        @type con: Room, PM or DummyConnection
+        @param con: connection to stop watching, its unsent data is dropped
+        """
+        with self.io_lock:
+            with self.write_lock:
+                self.write_queue = [item for item in self.write_queue if item[0] is not con]
+            self.outbufs.pop(con, None)
+            self.writable.discard(con)
+            try:
+                self.selector.unregister(con.sock)
+            except (KeyError, ValueError):
+                pass
+        with self.connect_cond:
+            self.connect_errors.pop(con, None)
+            if self.connecting.pop(con, None):
+                self.connect_cond.notify()
+
+    def updateEvents(self):
+        """
+        Find the events that have a real handler, connections skip every other event.
+
+        Runs on init, call it again after assigning handlers on the instance.
+        """
+        events = set()
+        for evt, default in vars(BotCallback).items():
+            if evt.startswith("on") and getattr(getattr(self, evt), "__func__", None) is not default:
+                events.add(evt)
+        if "onEventCalled" in events:
+            events.update(evt for evt in vars(BotCallback) if evt.startswith("on"))
+        self.events = frozenset(events)
 
     def callEvent(self, room, evt, *args, **kw):
         getattr(self, evt)(room, *args, **kw)
         self.onEventCalled(room, evt, *args, **kw)
 
+    def _makeReconnector(self):
+        return ch.reconnect.Reconnector(
+            self, delay=self.reconnectDelay, maxDelay=self.reconnectMaxDelay, jitter=self.reconnectJitter,
+            perServer=self.reconnectConcurrency, timeout=self.reconnectTimeout, attempts=self.reconnectAttempts)
+
+    def reloadWeights(self, path=None):
+        """
+        Reload the tag server weights without restarting, rooms joined afterwards use them.
+
+        @type path: str
+        @param path: the weights file, weightsFile if not given
+
+        @rtype: str
+        @return: version of the loaded weights
+        """
+        return ch.loadWeights(path or self.weightsFile)
+
     def getConnections(self):
         li = list(self.rooms.values())
         if self.pm:
@@ -537,10 +707,8 @@ class RoomManager(BotCallback):
     def start_threads(self):
         self.tick_thread = threading.Thread(target=self.tick_worker, name='tick_worker')
         self.tick_thread.start()
-        self.send_thread = threading.Thread(target=self.send_worker, name='send_worker')
-        self.send_thread.start()
-        self.recv_thread = threading.Thread(target=self.recv_worker, name='recv_worker')
-        self.recv_thread.start()
+        self.io_thread = threading.Thread(target=self.io_worker, name='io_worker')
+        self.io_thread.start()
         self.join_thread = threading.Thread(target=self.join_worker, name='join_worker', daemon=True)
         self.join_thread.start()
 
@@ -559,37 +727,159 @@ class RoomManager(BotCallback):
             self._tick()
 
     @ch.common.stop_on_error
-    def send_worker(self):
-        for sock, data in iter(self.sock_write_queue.get, None):
-            # print(data)
-            try:
-                sock.sendall(data)
-            except OSError:
-                pass
-
-    @ch.common.stop_on_error
-    def recv_worker(self):
+    def io_worker(self):
         while self.running:
-            conns = self.getConnections()
-            rd, wr, sp = select.select(conns, [], [])
-            for sock in rd:
-                con = conns[sock]
+            self._drainWrites()
+            for key, mask in self.selector.select(self._connectWait()):
+                con = key.data
+                if key.fileobj is not con.sock:
+                    continue  # unregistered meanwhile, maybe already on a new socket
+                if con in self.connecting:
+                    self._connected(con)
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(con)
+                if mask & selectors.EVENT_READ:
+                    try:
+                        data = key.fileobj.recv(self.recvSize)
+                        if len(data) > 0:
+                            con.feed(data)
+                        else:
+                            con._lost()
+                    except socket.error:
+                        pass
+            if self.connecting:
+                self._expireConnects()
+
+    def _connectWait(self):
+        """Seconds select may wait before the earliest connect times out, None if nothing is connecting."""
+        with self.connect_cond:
+            if not self.connecting:
+                return None
+            deadline = min(deadline for deadline, error in self.connecting.values())
+        return max(0, deadline - time.monotonic())
+
+    def _connected(self, con):
+        """The connect of a socket finished, one way or another."""
+        with self.connect_cond:
+            deadline, error = self.connecting.pop(con, (None, None))
+            if deadline is None:
+                return  # unregistered meanwhile
+            self.connect_cond.notify()
+        if error is None:
+            err = con.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                error = OSError(err, os.strerror(err))
+        if error is not None:
+            con._connectFail(error)
+            return
+        with self.io_lock:
+            self._watch(con, selectors.EVENT_READ)
+            self._flush(con)
+
+    def _expireConnects(self):
+        now = time.monotonic()
+        with self.connect_cond:
+            expired = [(con, error) for con, (deadline, error) in self.connecting.items() if deadline <= now]
+            for con, error in expired:
+                del self.connecting[con]
+            self.connect_cond.notify()
+        for con, error in expired:
+            con._connectFail(error or socket.timeout("timed out connecting to %s" % con.server))
+
+    def _drainWrites(self):
+        """Move queued frames into the per connection buffers and try to flush them."""
+        with self.io_lock:
+            with self.write_lock:
+                items, self.write_queue = self.write_queue, list()
+                self.write_notified = False
+            touched = dict()
+            for con, data in items:
+                if con.sock is None:
+                    continue
+                self.outbufs.setdefault(con, []).append(data)
+                touched[con] = None
+            for con in touched:
+                self._flush(con)
+
+    def _flush(self, con):
+        """
+        Send as much of a connection's buffer as the socket takes without blocking.
+
+        The socket is watched for writing only while data is left over.
+
+        @type con: Room or PM
+        @param con: connection to flush
+        """
+        with self.io_lock:
+            if con in self.connecting or con in self.connect_errors:
+                return  # sent once connected
+            chunks = self.outbufs.get(con)
+            if chunks:
                 try:
-                    data = sock.recv(1024)
-                    if len(data) > 0:
-                        con.feed(data)
+                    chunks = self._sendChunks(con.sock, chunks)
+                except OSError:
+                    chunks = None  # broken connection, the read side will notice
+            if chunks:
+                self.outbufs[con] = chunks
+                if con not in self.writable:
+                    self._watch(con, selectors.EVENT_READ | selectors.EVENT_WRITE)
+                    self.writable.add(con)
+            else:
+                self.outbufs.pop(con, None)
+                if con in self.writable:
+                    self._watch(con, selectors.EVENT_READ)
+                    self.writable.discard(con)
+
+    def _watch(self, con, events):
+        try:
+            self.selector.modify(con.sock, events, con)
+        except (KeyError, ValueError):
+            pass  # not registered yet (or anymore), register picks up the buffer
+
+    @staticmethod
+    def _sendChunks(sock, chunks):
+        """
+        Send a list of frames with as few syscalls as possible, without blocking.
+
+        @type sock: socket.socket
+        @param sock: non-blocking socket to send to
+        @type chunks: [bytes, ...]
+        @param chunks: frames in order
+
+        @rtype: [bytes, ...]
+        @return: what is left to send
+        """
+        chunks = [chunk for chunk in chunks if chunk]
+        i = 0
+        try:
+            while i < len(chunks):
+                if hasattr(sock, "sendmsg"):
+                    sent = sock.sendmsg(chunks[i:i + IOV_MAX])
+                else:
+                    sent = sock.send(chunks[i])
+                while sent:
+                    size = len(chunks[i])
+                    if sent >= size:
+                        sent -= size
+                        i += 1
                     else:
-                        con.disconnect()
-                except socket.error:
-                    pass
+                        chunks[i] = chunks[i][sent:]
+                        sent = 0
+        except BlockingIOError:
+            pass
+        return chunks[i:]
 
     @ch.common.stop_on_error
     def join_worker(self):
         for room, callback in iter(self.rooms_queue.get, None):
-            con = self.Room(room, mgr=self)
-            self.rooms[room] = con
+            with self.connect_cond:
+                while self.running and len(self.connecting) >= self.connectConcurrency:
+                    self.connect_cond.wait()
+            if room in self.rooms:
+                continue
+            self.Room(room, mgr=self)
             callback(room)
-            self.dummy_con.notify()
 
     @classmethod
     def easy_start(cls, rooms=None, name=None, password=None, pm=True):
@@ -608,18 +898,7 @@ class RoomManager(BotCallback):
         @type pm: bool
         @param pm: whether to connect to pm
         """
-        if rooms is None:
-            rooms = str(input("Room names separated by semicolons: ")).split(";")
-        if len(rooms) == 1 and rooms[0] == "":
-            rooms = []
-        if name is None:
-            name = str(input("User name: "))
-        if name == "":
-            name = None
-        if password is None:
-            password = str(input("User password: "))
-        if password == "":
-            password = None
+        rooms, name, password = ch.common.prompt_login(rooms, name, password)
         self = cls(name, password, pm=pm)
         for room in rooms:
             self.joinRoom(room)
@@ -627,18 +906,31 @@ class RoomManager(BotCallback):
 
     def stop(self):
         self.running = False
+        self.reconnector.clear()
+        with self.tasks_cond:
+            self.tasks_cond.notify()
+        with self.connect_cond:
+            self.connect_cond.notify()
         for conn in self.getConnections().values():
             conn.disconnect()
-        self.sock_write_queue.put(None)
         self.rooms_queue.put(None)
         self.dummy_con.notify()
 
+    def close(self):
+        """Release the reactor, call after stop once the threads are done."""
+        self.unregister(self.dummy_con)
+        self.dummy_con.close()
+        self.selector.close()
+
     ####
     # Properties
     ####
     @property
     def user(self):
-        return ch.User(self.name)
+        user = self._user
+        if user is None or user.name.lower() != (self.name or "").lower():  # name changed after init
+            user = self._user = ch.User(self.name)
+        return user
 
     @property
     def roomNames(self):
@@ -651,29 +943,55 @@ class RoomManager(BotCallback):
     class _Task:
         def __init__(self, mgr, isInterval, timeout, func, *args, **kw):
             self.mgr = mgr
-            self.target = time.time() + timeout
+            self.target = time.monotonic() + timeout
             self.timeout = timeout
             self.func = func
             self.isInterval = isInterval
             self.args = args
             self.kw = kw
+            self.cancelled = False
+            self.queued = False  # in the heap, waiting to run
 
         def cancel(self):
             """Sugar for removeTask."""
             self.mgr.removeTask(self)
 
     def _tick(self):
-
-        now = time.time()
-        for task in set(self.tasks):
-            if task.target <= now:
-                task.func(*task.args, **task.kw)
-                if task.isInterval:
-                    task.target = now + task.timeout
-                else:
-                    self.tasks.remove(task)
-
-        time.sleep(self.TimerResolution)
+        """Sleep until the earliest task is due, then run it."""
+        with self.tasks_cond:
+            while True:
+                if not self.running:
+                    return
+                if not self.tasks:
+                    self.tasks_cond.wait()
+                    continue
+                target, _, task = self.tasks[0]
+                if task.cancelled:
+                    heapq.heappop(self.tasks)
+                    task.queued = False
+                    self.tasks_cancelled -= 1
+                    continue
+                delay = target - time.monotonic()
+                if delay > 0:
+                    self.tasks_cond.wait(delay)
+                    continue
+                heapq.heappop(self.tasks)
+                task.queued = False
+                break
+
+        task.func(*task.args, **task.kw)
+        if task.isInterval and not task.cancelled:
+            task.target = time.monotonic() + task.timeout
+            self._addTask(task)
+
+    def _addTask(self, task):
+        with self.tasks_cond:
+            if task.cancelled:  # an interval cancelled while it ran
+                return
+            heapq.heappush(self.tasks, (task.target, next(self.tasks_seq), task))
+            task.queued = True
+            if self.tasks[0][2] is task:
+                self.tasks_cond.notify()
 
     def setTimeout(self, timeout, func, *args, **kw):
         """
@@ -689,7 +1007,7 @@ class RoomManager(BotCallback):
         @return: object representing the task
         """
         task = self._Task(self, False, timeout, func, *args, **kw)
-        self.tasks.add(task)
+        self._addTask(task)
         return task
 
     def setInterval(self, timeout, func, *args, **kw):
@@ -705,7 +1023,7 @@ class RoomManager(BotCallback):
         @return: object representing the task
         """
         task = self._Task(self, True, timeout, func, *args, **kw)
-        self.tasks.add(task)
+        self._addTask(task)
         return task
 
     def removeTask(self, task):
@@ -715,7 +1033,18 @@ class RoomManager(BotCallback):
         @type task: _Task
         @param task: task to cancel
         """
-        self.tasks.remove(task)
+        with self.tasks_cond:
+            if task.cancelled:
+                return
+            task.cancelled = True
+            if not task.queued:  # already ran or running, nothing left in the heap
+                return
+            self.tasks_cancelled += 1
+            # cancelled entries get dropped lazily, compact once they are the majority
+            if self.tasks_cancelled > len(self.tasks) // 2:
+                self.tasks = [entry for entry in self.tasks if not entry[2].cancelled]
+                heapq.heapify(self.tasks)
+                self.tasks_cancelled = 0
 
     ####
     # Deferring
@@ -766,8 +1095,7 @@ class RoomManager(BotCallback):
         """
         room = room.lower()
         if room in self.rooms:
-            con = self.rooms[room]
-            con.disconnect()
+            self.rooms[room].disconnect()
 
     def getRoom(self, room):
         """
@@ -787,26 +1115,26 @@ class RoomManager(BotCallback):
     ####
     def enableBg(self):
         """Enable background if available."""
-        self.user._mbg = True
-        for room in self.rooms:
+        self.user.mbg = True
+        for room in self.rooms.values():
             room.setBgMode(1)
 
     def disableBg(self):
         """Disable background."""
-        self.user._mbg = False
-        for room in self.rooms:
+        self.user.mbg = False
+        for room in self.rooms.values():
             room.setBgMode(0)
 
     def enableRecording(self):
         """Enable recording if available."""
-        self.user._mrec = True
-        for room in self.rooms:
+        self.user.mrec = True
+        for room in self.rooms.values():
             room.setRecordingMode(1)
 
     def disableRecording(self):
         """Disable recording."""
-        self.user._mrec = False
-        for room in self.rooms:
+        self.user.mrec = False
+        for room in self.rooms.values():
             room.setRecordingMode(0)
 
     def setNameColor(self, color3x):
@@ -816,7 +1144,7 @@ class RoomManager(BotCallback):
         @type color3x: str
         @param color3x: a 3-char RGB hex code for the color
         """
-        self.user._nameColor = color3x
+        self.user.nameColor = color3x
 
     def setFontColor(self, color3x):
         """
@@ -825,7 +1153,7 @@ class RoomManager(BotCallback):
         @type color3x: str
         @param color3x: a 3-char RGB hex code for the color
         """
-        self.user._fontColor = color3x
+        self.user.fontColor = color3x
 
     def setFontFace(self, face):
         """
@@ -834,7 +1162,7 @@ class RoomManager(BotCallback):
         @type face: str
         @param face: the font face
         """
-        self.user._fontFace = face
+        self.user.fontFace = face
 
     def setFontSize(self, size):
         """
@@ -843,4 +1171,4 @@ class RoomManager(BotCallback):
         @type size: int
         @param size: the font size (limited: 9 to 22)
         """
-        self.user._fontSize = min(max(size, 9), 22)
+        self.user.fontSize = min(max(size, 9), 22)
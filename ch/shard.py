@@ -0,0 +1,338 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+################################################################
+# Imports
+################################################################
+import multiprocessing
+import os
+import threading
+import zlib
+
+import ch
+
+
+def shardOf(room, shards):
+    """
+    Get the shard owning a room, stable across processes.
+
+    @type room: str
+    @param room: room name
+    @type shards: int
+    @param shards: number of shards
+
+    @rtype: int
+    @return: index of the owning shard
+    """
+    return zlib.crc32(room.lower().encode()) % shards
+
+
+################################################################
+# Remote proxies
+################################################################
+class _UserRef:
+    """Picklable stand-in for a User crossing a process boundary."""
+
+    def __init__(self, name):
+        self.name = name
+
+
+def _pack(args, kw):
+    args = tuple(_UserRef(a.name) if isinstance(a, ch.user._User) else a for a in args)
+    kw = {k: _UserRef(v.name) if isinstance(v, ch.user._User) else v for k, v in kw.items()}
+    return args, kw
+
+
+def _unpack(args, kw):
+    args = tuple(ch.User(a.name) if isinstance(a, _UserRef) else a for a in args)
+    kw = {k: ch.User(v.name) if isinstance(v, _UserRef) else v for k, v in kw.items()}
+    return args, kw
+
+
+class RemoteRoom:
+    """
+    Proxy for a room owned by another shard.
+
+    Only the commands in forwarded are available, they get sent to the
+    owning shard and return None. Arguments must be picklable, Users are
+    passed by name. State like the userlist can't be read from here.
+    """
+    forwarded = frozenset((
+        "message", "rawMessage", "setBgMode", "setRecordingMode", "addMod", "removeMod", "flagUser",
+        "deleteUser", "rawClearUser", "clearUser", "clearall", "rawBan", "banUser", "rawUnban", "unban",
+        "requestBanlist", "requestUnBanlist", "login", "logout", "get_more", "reconnect", "disconnect"))
+
+    def __init__(self, mgr, shard, name):
+        self.mgr = mgr
+        self.shard = shard
+        self.name = name
+
+    def __getattr__(self, attr):
+        if attr not in self.forwarded:
+            raise AttributeError("%s is owned by shard %d, %r isn't forwarded there" % (self.name, self.shard, attr))
+
+        def call(*args, **kw):
+            self.mgr.post(self.shard, ("room", self.name, attr) + _pack(args, kw))
+        return call
+
+    def __repr__(self):
+        return "<RemoteRoom: %s (shard %d)>" % (self.name, self.shard)
+
+
+class RemotePM:
+    """Proxy for the PM connection owned by another shard, see RemoteRoom."""
+    name = '#PM'
+    connected = True
+    forwarded = frozenset(("message", "addContact", "removeContact", "block", "unblock", "track", "disconnect"))
+
+    def __init__(self, mgr, shard):
+        self.mgr = mgr
+        self.shard = shard
+
+    def __getattr__(self, attr):
+        if attr not in self.forwarded:
+            raise AttributeError("PM is owned by shard %d, %r isn't forwarded there" % (self.shard, attr))
+
+        def call(*args, **kw):
+            self.mgr.post(self.shard, ("pm", attr) + _pack(args, kw))
+        return call
+
+    def getConnections(self):
+        return []
+
+
+################################################################
+# Shard side
+################################################################
+# noinspection PyPep8Naming
+class ShardMixin:
+    """
+    Mixed into the bot class inside every shard process.
+
+    Rooms owned by other shards are reached through RemoteRoom,
+    the PM connection lives in shard 0 and is reached through RemotePM elsewhere.
+    Shards tell each other when their rooms connect and disconnect.
+    """
+    shardIndex = 0
+    shardInboxes = ()
+    announced = frozenset(("onConnect", "onReconnect", "onDisconnect", "onConnectFail"))
+
+    ####
+    # Util
+    ####
+    def _setup(self, name, password):
+        super()._setup(name, password)
+        self.remoteRooms = dict()  # room name -> shard, for rooms other shards are connected to
+
+    def post(self, shard, item):
+        self.shardInboxes[shard].put(item)
+
+    def isLocal(self, room):
+        # before the shards are wired up everything is local
+        return not self.shardInboxes or shardOf(room, len(self.shardInboxes)) == self.shardIndex
+
+    def updateEvents(self):
+        super().updateEvents()
+        self.events = self.events | self.announced
+
+    def callEvent(self, room, evt, *args, **kw):
+        if evt in self.announced and room is not self.pm:
+            item = ("joined", room.name, self.shardIndex) if evt in ("onConnect", "onReconnect") else ("left", room.name)
+            for shard in range(len(self.shardInboxes)):
+                if shard != self.shardIndex:
+                    self.post(shard, item)
+        super().callEvent(room, evt, *args, **kw)
+
+    ####
+    # Main
+    ####
+    def main(self):
+        super().main()
+        thread = threading.Thread(target=self.shard_worker, name='shard_worker')
+        thread.start()
+
+    @ch.common.stop_on_error
+    def shard_worker(self):
+        for item in iter(self.shardInboxes[self.shardIndex].get, None):
+            self.setTimeout(0, self._shardCall, *item)
+
+    def _shardCall(self, op, *args):
+        if op == "join":
+            self.joinRoom(*args)
+        elif op == "leave":
+            self.leaveRoom(*args)
+        elif op == "room":
+            name, attr, args, kw = args
+            room = self.rooms.get(name)
+            if room:
+                args, kw = _unpack(args, kw)
+                getattr(room, attr)(*args, **kw)
+        elif op == "pm":
+            attr, args, kw = args
+            if self.pm:
+                args, kw = _unpack(args, kw)
+                getattr(self.pm, attr)(*args, **kw)
+        elif op == "joined":
+            name, shard = args
+            self.remoteRooms[name] = shard
+        elif op == "left":
+            self.remoteRooms.pop(args[0], None)
+        elif op == "broadcast":
+            msg, kw = args
+            for room in list(self.rooms.values()):
+                room.message(msg, **kw)
+        elif op == "stop":
+            self.stop()
+
+    def stop(self):
+        super().stop()
+        self.post(self.shardIndex, None)
+
+    ####
+    # Join/leave
+    ####
+    def joinRoom(self, room, callback=lambda x: None):
+        room = room.lower()
+        if self.isLocal(room):
+            super().joinRoom(room, callback)
+        else:
+            self.post(shardOf(room, len(self.shardInboxes)), ("join", room))
+
+    def leaveRoom(self, room):
+        room = room.lower()
+        if self.isLocal(room):
+            super().leaveRoom(room)
+        else:
+            self.post(shardOf(room, len(self.shardInboxes)), ("leave", room))
+
+    def getRoom(self, room):
+        """
+        Get room with a name, a RemoteRoom if another shard is connected to it, None if no shard is.
+
+        @type room: str
+        @param room: room
+
+        @rtype: Room
+        @return: the room
+        """
+        room = room.lower()
+        if self.isLocal(room):
+            return super().getRoom(room)
+        shard = self.remoteRooms.get(room)
+        return None if shard is None else RemoteRoom(self, shard, room)
+
+    def broadcast(self, msg, **kw):
+        """
+        Send a message to every room of every shard.
+
+        @type msg: str
+        @param msg: message
+        """
+        for shard in range(len(self.shardInboxes)):
+            self.post(shard, ("broadcast", msg, kw))
+
+
+def _shard_main(bot, index, inboxes, name, password, pm, rooms):
+    # wired up before init, handlers running from there on can already reach other shards
+    cls = type(bot.__name__, (ShardMixin, bot), {"shardIndex": index, "shardInboxes": inboxes})
+    self = cls(name, password, pm=pm and index == 0)
+    if pm and index != 0:
+        self.pm = RemotePM(self, 0)
+    for room in rooms:
+        self.joinRoom(room)
+    self.main()
+
+
+################################################################
+# ShardedRoomManager class
+################################################################
+class ShardedRoomManager:
+    """Runs a RoomManager subclass in several processes, spreading the rooms across them."""
+
+    def __init__(self, bot, shards=None, name=None, password=None, pm=True):
+        """
+        @type bot: type
+        @param bot: RoomManager subclass instantiated in every shard
+
+        @type shards: int
+        @param shards: number of processes, defaults to the cpu count
+        """
+        self.bot = bot
+        self.shards = shards or os.cpu_count() or 1
+        self.name = name
+        self.password = password
+        self.pm = pm
+        self.context = multiprocessing.get_context()
+        self.inboxes = [self.context.Queue() for _ in range(self.shards)]
+        self.rooms = [list() for _ in range(self.shards)]
+        self.processes = list()
+
+    def joinRoom(self, room):
+        """
+        Join a room on its owning shard.
+
+        @type room: str
+        @param room: room to join
+        """
+        room = room.lower()
+        shard = shardOf(room, self.shards)
+        if self.processes:
+            self.inboxes[shard].put(("join", room))
+        elif room not in self.rooms[shard]:
+            self.rooms[shard].append(room)
+
+    def main(self):
+        for index in range(self.shards):
+            process = self.context.Process(
+                target=_shard_main, name='shard %d' % index,
+                args=(self.bot, index, self.inboxes, self.name, self.password, self.pm, self.rooms[index]))
+            process.start()
+            self.processes.append(process)
+        try:
+            for process in self.processes:
+                process.join()
+        except KeyboardInterrupt:
+            self.stop()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+
+    @classmethod
+    def easy_start(cls, bot, rooms=None, name=None, password=None, pm=True, shards=None):
+        """
+        Prompts the user for missing info, then starts.
+
+        @type bot: type
+        @param bot: RoomManager subclass instantiated in every shard
+
+        @type rooms: list
+        @param rooms: rooms to join
+
+        @type name: str
+        @param name: name to join as ("" = None, None = unspecified)
+
+        @type password: str
+        @param password: password to join with ("" = None, None = unspecified)
+
+        @type pm: bool
+        @param pm: whether to connect to pm
+
+        @type shards: int
+        @param shards: number of processes, defaults to the cpu count
+        """
+        rooms, name, password = ch.common.prompt_login(rooms, name, password)
+        self = cls(bot, shards=shards, name=name, password=password, pm=pm)
+        for room in rooms:
+            self.joinRoom(room)
+        self.main()
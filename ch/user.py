@@ -14,34 +14,210 @@
 ################################################################
 # Imports
 ################################################################
+import collections
+import threading
+import weakref
+
 import ch
 
 
+################################################################
+# User registry
+################################################################
+class _Stripe:
+    """One slice of the registry, with its own lock."""
+    __slots__ = ("lock", "refs", "recent", "gone", "dead", "created", "evicted", "resurrected")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.refs = dict()  # lowercased name -> weakref to user
+        self.recent = collections.OrderedDict()  # lowercased name -> user, least recently used first
+        self.gone = collections.OrderedDict()  # lowercased names of evicted users
+        self.dead = collections.deque()  # (name, weakref) of collected users, not yet swept
+        self.created = 0
+        self.evicted = 0
+        self.resurrected = 0
+
+
+class Registry:
+    """
+    Name to user lookup that forgets users nobody uses anymore.
+
+    Users are held weakly, anything still referencing one (a room's
+    userlist, mods, banlist or history, the PM contacts, the bot itself)
+    keeps it alive. On top of that the most recently used users are
+    kept alive, so state survives short gaps. With keep set to None
+    nothing is ever evicted.
+
+    Names are spread over stripes, each with its own lock, which also
+    guards the state of the users in it, so the recv thread, the join
+    thread and deferred threads only contend when they touch the same
+    stripe.
+    """
+
+    ####
+    # Init
+    ####
+    def __init__(self, keep=4096, remember=65536, stripes=16):
+        """
+        @type keep: int
+        @param keep: number of recently used users kept alive, None to keep all
+
+        @type remember: int
+        @param remember: number of evicted names remembered to count resurrections
+
+        @type stripes: int
+        @param stripes: number of locks
+        """
+        self.keep = keep
+        self.remember = remember
+        self.stripes = [_Stripe() for _ in range(stripes)]
+
+    ####
+    # Util
+    ####
+    def _stripe(self, lname):
+        return self.stripes[hash(lname) % len(self.stripes)]
+
+    def _sweep(self, stripe):
+        # collected users get queued by the weakref callback, which may run
+        # in any thread holding any lock, and swept here under the stripe lock
+        while stripe.dead:
+            lname, ref = stripe.dead.popleft()
+            if stripe.refs.get(lname) is ref:
+                del stripe.refs[lname]
+            stripe.evicted += 1
+            stripe.gone[lname] = None
+        remember = self.remember // len(self.stripes)
+        while len(stripe.gone) > remember:
+            stripe.gone.popitem(last=False)
+
+    def _trim(self, stripe):
+        if self.keep is not None:
+            keep = -(-self.keep // len(self.stripes))
+            while len(stripe.recent) > keep:
+                stripe.recent.popitem(last=False)
+
+    ####
+    # Lookup
+    ####
+    def lock(self, name):
+        """
+        Get the lock guarding a user.
+
+        @type name: str
+        @param name: name of the user
+
+        @rtype: threading.RLock
+        @return: lock
+        """
+        return self._stripe(name.lower()).lock
+
+    def get(self, name, **kw):
+        """
+        Get the user with a name, creating it if needed.
+
+        @type name: str
+        @param name: name
+        @param kw: passed to update while still holding the lock
+
+        @rtype: User
+        @return: the user
+        """
+        lname = name.lower()
+        stripe = self._stripe(lname)
+        with stripe.lock:
+            self._sweep(stripe)
+            ref = stripe.refs.get(lname)
+            user = ref() if ref is not None else None
+            if user is None:
+                user = _User(name)
+                stripe.refs[lname] = weakref.ref(user, lambda r, n=lname, d=stripe.dead: d.append((n, r)))
+                stripe.created += 1
+                if lname in stripe.gone:
+                    del stripe.gone[lname]
+                    stripe.resurrected += 1
+            stripe.recent[lname] = user
+            stripe.recent.move_to_end(lname)
+            self._trim(stripe)
+            if kw:
+                user.update(**kw)
+        return user
+
+    def resize(self, keep):
+        """
+        Change how many recently used users are kept alive.
+
+        @type keep: int
+        @param keep: number of users, None to keep all
+        """
+        self.keep = keep
+        for stripe in self.stripes:
+            with stripe.lock:
+                self._trim(stripe)
+
+    def clear(self):
+        """Stop keeping users alive, users still referenced elsewhere stay."""
+        for stripe in self.stripes:
+            with stripe.lock:
+                stripe.recent.clear()
+
+    ####
+    # Stats
+    ####
+    @property
+    def live(self):
+        return self.stats()["live"]
+
+    def stats(self):
+        """
+        Get registry statistics.
+
+        @rtype: dict
+        @return: live, kept, created, evicted and resurrected user counts
+        """
+        stats = dict.fromkeys(("live", "kept", "created", "evicted", "resurrected"), 0)
+        for stripe in self.stripes:
+            with stripe.lock:
+                self._sweep(stripe)
+                stats["live"] += len(stripe.refs)
+                stats["kept"] += len(stripe.recent)
+                stats["created"] += stripe.created
+                stats["evicted"] += stripe.evicted
+                stats["resurrected"] += stripe.resurrected
+        return stats
+
+    def __len__(self):
+        return self.live
+
+    def __contains__(self, name):
+        lname = name.lower()
+        ref = self._stripe(lname).refs.get(lname)
+        return ref is not None and ref() is not None
+
+    def __repr__(self):
+        stats = self.stats()
+        return "<Registry: %d live, %d kept>" % (stats["live"], stats["kept"])
+
+
 ################################################################
 # User factory
 ################################################################
-_users = dict()
+registry = Registry()
 
 
 def User(name, **kw):
     if not name:
         return
 
-    lname = name.lower()
-
-    user = _users.get(lname)
-    if not user:
-        user = _User(name)
-        _users[lname] = user
-
-    if kw:
-        user.update(**kw)
-
-    return user
+    return registry.get(name, **kw)
 
 
 class _User:
     """Class that represents a user."""
+    # __dict__ keeps arbitrary attributes working, it only gets allocated once one is set
+    __slots__ = ("name", "puid", "puids", "ip", "ips", "_perms", "room", "_sids", "_msgs", "mbg", "mrec",
+                 "_style", "_nameColor", "_fontSize", "_fontFace", "_fontColor", "__weakref__", "__dict__")
 
     ####
     # Init
@@ -52,14 +228,15 @@ class _User:
         self.puids = set()
         self.ip = None
         self.ips = set()
-        self.perms = dict()
+        self._perms = None  # perms, sids and msgs only get a container once used
         self.room = None
-        self.sids = dict()
-        self.msgs = list()
-        self.nameColor = "000"
-        self.fontSize = 12
-        self.fontFace = "0"
-        self.fontColor = "000"
+        self._sids = None
+        self._msgs = None
+        self._style = None
+        self._nameColor = "000"
+        self._fontSize = 12
+        self._fontFace = "0"
+        self._fontColor = "000"
         self.mbg = False
         self.mrec = False
 
@@ -67,13 +244,14 @@ class _User:
     # Update Handler
     ####
     def update(self, **kw):
-        for attr, val in kw.items():
-            if val is None:
-                continue
-            if hasattr(self, "_h_" + attr):
-                getattr(self, "_h_" + attr)(val)
-            else:
-                setattr(self, attr, val)
+        with registry.lock(self.name):
+            for attr, val in kw.items():
+                if val is None:
+                    continue
+                if hasattr(self, "_h_" + attr):
+                    getattr(self, "_h_" + attr)(val)
+                else:
+                    setattr(self, attr, val)
 
     def _h_ip(self, val):
         self.ip = val
@@ -86,31 +264,133 @@ class _User:
     def _h_perm(self, val):
         self.perms[val[0]] = ch.common.Perm(val[1])
 
+    def _h_style(self, val):
+        # applied lazily, most bots never read the font of other users
+        if self._style is not None:
+            # keep what the pending message set and the new one doesn't
+            self._applyStyle()
+        self._style = val
+
+    def _applyStyle(self):
+        with registry.lock(self.name):
+            style = self._style
+            if style is None:  # applied by another thread meanwhile
+                return
+            nameColor, fontColor, fontFace, fontSize = style.style()
+            if nameColor is not None:
+                self._nameColor = nameColor
+            if fontColor is not None:
+                self._fontColor = fontColor
+            if fontFace is not None:
+                self._fontFace = fontFace
+            if fontSize is not None:
+                self._fontSize = fontSize
+            # cleared last, readers that still see it wait on the lock for the fields
+            self._style = None
+
     def _h_participant(self, val):
-        if val[0] == '1':  # join
-            if val[1] not in self.sids:
-                self.sids[val[1]] = set()
-            self.sids[val[1]].add(val[2])
-        elif val[0] == '0':  # leave
-            if val[1] in self.sids:
-                self.sids[val[1]].remove(val[2])
-                if not self.sids[val[1]]:
-                    del self.sids[val[1]]
+        status, room, sid = val
+        if status == '1':  # join
+            self.sids.setdefault(room, set()).add(sid)
+        elif status == '0':  # leave
+            sids = self.sids.get(room)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self.sids[room]
 
     ####
     # Properties
     ####
+    @property
+    def perms(self):
+        if self._perms is None:
+            with registry.lock(self.name):
+                if self._perms is None:
+                    self._perms = dict()
+        return self._perms
+
+    @property
+    def sids(self):
+        if self._sids is None:
+            with registry.lock(self.name):
+                if self._sids is None:
+                    self._sids = dict()
+        return self._sids
+
+    @property
+    def msgs(self):
+        if self._msgs is None:
+            with registry.lock(self.name):
+                if self._msgs is None:
+                    self._msgs = list()
+        return self._msgs
+
+    @msgs.setter
+    def msgs(self, val):
+        self._msgs = val
+
+    @property
+    def nameColor(self):
+        if self._style is not None:
+            self._applyStyle()
+        return self._nameColor
+
+    @nameColor.setter
+    def nameColor(self, val):
+        with registry.lock(self.name):
+            self._applyStyle()
+            self._nameColor = val
+
+    @property
+    def fontColor(self):
+        if self._style is not None:
+            self._applyStyle()
+        return self._fontColor
+
+    @fontColor.setter
+    def fontColor(self, val):
+        with registry.lock(self.name):
+            self._applyStyle()
+            self._fontColor = val
+
+    @property
+    def fontFace(self):
+        if self._style is not None:
+            self._applyStyle()
+        return self._fontFace
+
+    @fontFace.setter
+    def fontFace(self, val):
+        with registry.lock(self.name):
+            self._applyStyle()
+            self._fontFace = val
+
+    @property
+    def fontSize(self):
+        if self._style is not None:
+            self._applyStyle()
+        return self._fontSize
+
+    @fontSize.setter
+    def fontSize(self, val):
+        with registry.lock(self.name):
+            self._applyStyle()
+            self._fontSize = val
+
     @property
     def sessionids(self):
-        return set.union(*self.sids.values())
+        with registry.lock(self.name):
+            return set().union(*self.sids.values())
 
     @property
     def rooms(self):
-        return list(self.sids.keys())
+        with registry.lock(self.name):
+            return list(self.sids.keys())
 
     @property
     def roomNames(self):
-        return [room.name for room in self.sids.keys()]
+        return [room.name for room in self.rooms]
 
     ####
     # Util
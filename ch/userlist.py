@@ -0,0 +1,111 @@
+################################################################
+# Title: Chatango Library
+# Original Author: Lumirayz/Lumz <lumirayz@gmail.com>
+# Version: 1.4.0
+################################################################
+
+################################################################
+# License
+################################################################
+# Copyright 2011 Lumirayz
+# Copyright 2015 asl97 & aqua101
+# This program is distributed under the terms of the GNU AGPL 3
+
+
+################################################################
+# UserList class
+################################################################
+class UserList:
+    """
+    Participants of a room, a user is counted once per session.
+
+    Join, leave, membership, the unique listing and lookup by name
+    (case insensitive) are O(1). Iterating yields each user once per
+    session like the list it replaces.
+    """
+
+    ####
+    # Init
+    ####
+    def __init__(self):
+        self.counts = dict()  # user -> number of sessions
+        self.names = dict()  # lowercased name -> user
+        self.size = 0
+
+    ####
+    # Modify
+    ####
+    def append(self, user):
+        """
+        Add a session of a user.
+
+        @type user: User
+        @param user: user
+        """
+        count = self.counts.get(user, 0)
+        self.counts[user] = count + 1
+        if not count:
+            self.names[user.name.lower()] = user
+        self.size += 1
+
+    def discard(self, user):
+        """
+        Remove a session of a user, if there is one.
+
+        @type user: User
+        @param user: user
+        """
+        count = self.counts.get(user)
+        if count is None:
+            return
+        if count == 1:
+            del self.counts[user]
+            del self.names[user.name.lower()]
+        else:
+            self.counts[user] = count - 1
+        self.size -= 1
+
+    def clear(self):
+        self.counts.clear()
+        self.names.clear()
+        self.size = 0
+
+    ####
+    # Lookup
+    ####
+    def count(self, user):
+        """Number of sessions of a user."""
+        return self.counts.get(user, 0)
+
+    def unique(self):
+        """List of the users, once each."""
+        return list(self.counts)
+
+    def find(self, name):
+        """
+        Get a user by name, ignoring case.
+
+        @type name: str
+        @param name: name
+
+        @rtype: User
+        @return: the user, or None if not in the room
+        """
+        return self.names.get(name.lower())
+
+    ####
+    # Sequence
+    ####
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for user, count in list(self.counts.items()):
+            for _ in range(count):
+                yield user
+
+    def __contains__(self, user):
+        return user in self.counts
+
+    def __repr__(self):
+        return "<UserList: %d users, %d sessions>" % (len(self.counts), self.size)
@@ -1,30 +1,39 @@
+import argparse
 import json
 import re
 import urllib.request
 import zlib
 
+import ch
 
-def findid():
-    url = urllib.request.urlopen("http://st.chatango.com/js/gz/emb_fullsize.js")
-    if url.getheader('Content-Encoding') == "gzip":
-        print("Server weights encoded with gzip, decoding...")
-        data = zlib.decompress(url.read(), 47).decode(encoding='ascii', errors='ignore')
-    else:
-        data = url.read()
-    return 'r' + re.search('this.qc="(\d+)"', data).group(1)
+JS_URL = "http://st.chatango.com/js/gz/emb_fullsize.js"
+HTML_URL = "http://st.chatango.com/h5/gz/%s/id.html"
 
 
-# noinspection PyShadowingNames,PyShadowingNames
-def findweights(_id):
-    url = urllib.request.urlopen("http://st.chatango.com/h5/gz/%s/id.html" % _id)
-    print("Found server weights.")
+def fetch(url):
+    url = urllib.request.urlopen(url)
+    data = url.read()
     if url.getheader('Content-Encoding') == "gzip":
-        print("Server weights encoded with gzip, decoding...")
-        data = zlib.decompress(url.read(), 47)
-    else:
-        data = url.read()
+        print("Encoded with gzip, decoding...")
+        data = zlib.decompress(data, 47)
+    return data.decode("utf-8", "ignore")
+
+
+def readfile(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:2] == b"\x1f\x8b":
+        data = zlib.decompress(data, 47)
+    return data.decode("utf-8", "ignore")
+
+
+def findid(data):
+    return 'r' + re.search(r'this.qc="(\d+)"', data).group(1)
+
+
+def findweights(data):
     print("Processing server weights...")
-    data = data.decode("utf-8", "ignore").splitlines()
+    data = data.splitlines()
     tags = json.loads(data[7].split(" = ")[-1])
     weights = []
     for a, b in tags["sm"]:
@@ -33,23 +42,37 @@ def findweights(_id):
     return weights
 
 
-# noinspection PyShadowingNames
-def updatech(weights):
-    print("Writing server weights to ch.py...")
-    with open("ch.py", "r+") as ch:
-        rdata = ch.read()
-        wdata = re.sub("tsweights = \[\[.*?\]\]", "tsweights = %s" % str(weights), rdata, flags=re.DOTALL)
-        ch.seek(0)
-        ch.write(wdata)
-        ch.truncate()
-
-
-print("Searching for latest server weights list...")
-_id = findid()
-print("Server weight list found!")
-print("_id: " + _id)
-print("Retrieving server weights...")
-weights = findweights(_id)
-# print(weights)
-updatech(weights)
-print("The server weights are now updated for ch.py, enjoy!")
+def main():
+    parser = argparse.ArgumentParser(description="Update the tag server weights file used by ch.")
+    parser.add_argument("--js", help="saved copy of emb_fullsize.js, instead of fetching it")
+    parser.add_argument("--html", help="saved copy of id.html, instead of fetching it")
+    parser.add_argument("--version", help="version to record, the id found in emb_fullsize.js by default")
+    parser.add_argument("-o", "--output", default=ch.weightsFile, help="weights file to write (%(default)s)")
+    args = parser.parse_args()
+
+    _id = args.version
+    if args.html:
+        print("Reading server weights from %s..." % args.html)
+        data = readfile(args.html)
+    else:
+        if not _id:
+            print("Searching for latest server weights list...")
+            _id = findid(readfile(args.js) if args.js else fetch(JS_URL))
+            print("_id: " + _id)
+        print("Retrieving server weights...")
+        data = fetch(HTML_URL % _id)
+    if not _id and args.js:
+        _id = findid(readfile(args.js))
+    weights = findweights(data)
+
+    try:
+        specials = ch.readWeights(args.output)[1]
+    except (OSError, ValueError, KeyError):
+        specials = ch.specials
+    ch.writeWeights(weights, specials, _id or "unknown", args.output)
+    print("Wrote %d server weights to %s, running bots pick them up with reloadWeights()." %
+          (len(weights), args.output))
+
+
+if __name__ == "__main__":
+    main()